@@ -29,18 +29,228 @@
 
 import struct
 import socket, json, os
+import threading
+import time
+import zlib
+import mmap
+import bisect
+
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
 
 SECTOR_SIZE = 512
+PART_SIZE = 1024*1024*1024*1024
+ZERO_BUFFER = memoryview(bytes(1024*1024))
 VERBOSE=0
 VERBOSEERR=1
 
+# Number of idle connections kept open to the block server, 0 disables pooling
+POOL_SIZE = 4
+# Seconds an idle pooled connection is kept before it is closed
+POOL_IDLE_TIMEOUT = 30
+# Upper bound on the request bytes sent ahead of the replies when pipelining
+PIPELINE_WINDOW = 64*1024
+
+RECV_BUFSIZE = 64*1024
+
+REPLY_HDR = struct.Struct('=BQQ')
+TAGGED_HDR = struct.Struct('=BIQQ')
+
+# Protocol v2, see block_server/server.py
+PROTO_VERSION = 2
+HELLO_HDR = struct.Struct('=BHI')
+DEVICE_HDR = struct.Struct('=BH')
+DEVICE_REPLY = struct.Struct('=BI')
+VECTOR_HDR = struct.Struct('=BII')
+VECTOR_SEGMENT = struct.Struct('=IQQ')
+COMPRESSED_HDR = struct.Struct('=BI')
+
+CAP_ZERO = 1
+CAP_ZLIB = 2
+CAP_LZ4 = 4
+CAP_IDLE = 8
+
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+BAD_DEVICE = 0xffffffff
+
+
+class _FrameReader:
+    """
+    Buffered reader for the reply stream. Headers are parsed in place and
+    large payloads are received straight into the destination buffer, so
+    a small reply costs a single recv call.
+    """
+
+    def __init__(self, sock, bufsize=RECV_BUFSIZE):
+        self._sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def _recv_into(self, view):
+        nbytes = self._sock.recv_into(view)
+        if nbytes == 0:
+            raise EOFError("Connection closed by the block server")
+        return nbytes
+
+    def _fill(self, n):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._start + n > len(self._buf):
+            avail = self._end - self._start
+            self._view[:avail] = self._view[self._start:self._end]
+            self._start, self._end = 0, avail
+        while self._end - self._start < n:
+            self._end += self._recv_into(self._view[self._end:])
+
+    def unpack(self, fmt):
+        self._fill(fmt.size)
+        values = fmt.unpack_from(self._buf, self._start)
+        self._start += fmt.size
+        return values
+
+    def read_into(self, view):
+        l = len(view)
+        if self._end - self._start < l and l <= len(self._buf) // 4:
+            # Small payloads go through the buffer together with the next header
+            self._fill(l)
+        n = min(l, self._end - self._start)
+        view[:n] = self._view[self._start:self._start+n]
+        self._start += n
+        while n < l:
+            n += self._recv_into(view[n:])
+
+
+class _Connection:
+    """
+    Long-lived connection to the block server. Requests are tagged with
+    increasing request IDs and the server answers them in order.
+    """
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = _FrameReader(self.sock)
+        self.proto = 1
+        self.caps = 0
+        self.devices = {}
+        self._next_tag = 0
+
+    def hello(self, caps):
+        """
+        Negotiates protocol v2. Servers that only speak v1 drop the connection.
+        """
+        self.sock.sendall(HELLO_HDR.pack(ord('H'), PROTO_VERSION, caps))
+        a, version, caps = self.reader.unpack(HELLO_HDR)
+        if a != ord('h'):
+            raise IOError("Unexpected handshake reply '%d'" %(a))
+        self.proto = version
+        self.caps = caps
+
+    def register_devices(self, paths):
+        paths = [p for p in set(paths) if p not in self.devices]
+        request = bytearray()
+        for path in paths:
+            enc_name = path.encode('utf8')
+            request += DEVICE_HDR.pack(ord('D'), len(enc_name)) + enc_name
+        self.sock.sendall(request)
+        for path in paths:
+            a, devid = self.reader.unpack(DEVICE_REPLY)
+            if a != ord('d') or devid == BAD_DEVICE:
+                raise IOError("Cannot register device {}".format(path))
+            self.devices[path] = devid
+
+    def new_tag(self):
+        tag = self._next_tag
+        self._next_tag = (self._next_tag + 1) & 0xffffffff
+        return tag
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class _HoleMap:
+    """
+    Lazily built map of the data and hole extents of a sparse image. Every
+    probe with SEEK_DATA/SEEK_HOLE is remembered, so each extent costs at
+    most two lseek calls.
+    """
+
+    def __init__(self, fd, size):
+        self._fd = fd
+        self._size = size
+        self._starts = []
+        self._extents = []
+        self._lock = threading.Lock()
+
+    def is_hole(self, offset, count):
+        end = offset + count
+        if end > self._size:
+            return False
+        with self._lock:
+            i = bisect.bisect_right(self._starts, offset) - 1
+            if i >= 0 and offset < self._extents[i][1]:
+                start, e, hole = self._extents[i]
+            else:
+                start, e, hole = self._probe(offset)
+                i = bisect.bisect_right(self._starts, start)
+                self._starts.insert(i, start)
+                self._extents.insert(i, (start, e, hole))
+        return hole and end <= e
+
+    def _probe(self, offset):
+        try:
+            data = os.lseek(self._fd, offset, os.SEEK_DATA)
+        except OSError:
+            # No data past offset
+            return offset, self._size, True
+        if data > offset:
+            return offset, data, True
+        return offset, os.lseek(self._fd, offset, os.SEEK_HOLE), False
+
+
+def _zeros(count):
+    if count <= len(ZERO_BUFFER):
+        return ZERO_BUFFER[:count]
+    return bytes(count)
+
+
 class BlockProxy:
+    """
+    Reads device blocks from a block server, or from local image files in
+    files mode. Connections to the server are kept in a pool and shared by
+    all threads reading through the proxy. A readv() goes out as a single
+    vector request, so a whole batch of blocks costs one round trip. Callers
+    overlap reads by calling from several threads, as BlockPipeline and
+    PoolDevice do, and every thread gets a connection of its own.
+    """
 
-    def __init__(self, host_port):
+    def __init__(self, host_port, pool_size=POOL_SIZE, compression=None):
         self.host = host_port[0]
         self.port = host_port[1]
         self._use_files = False
         self._use_1tb = False
+        self._pool_size = pool_size
+        self._proto = PROTO_VERSION
+        self._caps = CAP_ZERO | CAP_IDLE
+        if compression == 'zlib':
+            self._caps |= CAP_ZLIB
+        elif compression == 'lz4':
+            if lz4block is None:
+                print("[-] BlockProxy: lz4 module missing, not using compression")
+            else:
+                self._caps |= CAP_LZ4
+        elif compression is not None:
+            raise ValueError("Unknown compression {}".format(compression))
+        self._pool = []
+        self._pool_lock = threading.Lock()
         if self.host == 'files:':
             self._init_files()
 
@@ -65,10 +275,14 @@ class BlockProxy:
                     raise Exception("Expecting parts to be <= 1TB")
 
     def read(self, dev_path, offset, count):
+        """
+        Reads count bytes at offset. In files mode the result is a read-only
+        memoryview of the mapped image.
+        """
         if self._use_files:
             return self._read_files(dev_path, offset, count)
         else:
-            return self._read_network(dev_path, offset, count)
+            return self._readv_network([(dev_path, offset, count)])
 
     def readv(self, blockv):
         if self._use_files:
@@ -76,64 +290,235 @@ class BlockProxy:
         else:
             return self._readv_network(blockv)
 
-    def _read_network(self, dev_path, offset, count):
-        buf = bytearray(count)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            sock.connect((self.host, self.port))
-            request = struct.pack('=BB', ord('r'), 1)
-            sock.sendall(request)
-            self._read_network_buf(sock, buf, 0, dev_path, offset, count)
-        finally:
-            sock.close()
-        return buf
-        
+    def readv_segments(self, blockv):
+        """
+        Same as readv() but returns one buffer per segment. In files mode the
+        segments are slices of the mapped images and nothing gets copied.
+        """
+        if self._use_files:
+            return [self._read_files(b[0], b[1], b[2]) for b in blockv]
+        view = memoryview(self._readv_network(blockv))
+        segments = []
+        boff = 0
+        for b in blockv:
+            segments.append(view[boff:boff+b[2]])
+            boff += b[2]
+        return segments
+
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+        for conn, idle_since in pool:
+            conn.close()
+
+    def _expire(self):
+        # Closes the pooled connections that were idle for too long. Must be
+        # called with the pool lock held.
+        deadline = time.monotonic() - POOL_IDLE_TIMEOUT
+        while self._pool and self._pool[0][1] < deadline:
+            self._pool.pop(0)[0].close()
+
+    def _acquire(self):
+        with self._pool_lock:
+            self._expire()
+            if self._pool:
+                return self._pool.pop()[0]
+        conn = _Connection(self.host, self.port)
+        if self._proto >= 2:
+            try:
+                conn.hello(self._caps)
+            except (OSError, EOFError):
+                # Fall back to the v1 framing for old servers
+                conn.close()
+                self._proto = 1
+                conn = _Connection(self.host, self.port)
+        return conn
+
+    def _release(self, conn):
+        # Only servers that do not tie up a thread per open connection get
+        # connections kept open, the others get a new one per request
+        if conn.caps & CAP_IDLE:
+            with self._pool_lock:
+                self._expire()
+                if len(self._pool) < self._pool_size:
+                    self._pool.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def _with_connection(self, func):
+        # An idle pooled connection might have been dropped by the server,
+        # so retry once over a fresh connection
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                result = func(conn)
+            except (OSError, EOFError) as e:
+                conn.close()
+                if attempt > 0:
+                    raise
+                if VERBOSEERR:
+                    print("[-] BlockProxy: reconnecting ({})".format(e))
+                continue
+            self._release(conn)
+            return result
+
     def _readv_network(self, blockv):
-        
+        return self._network(lambda conn: self._pipeline(conn, [blockv])[0],
+                             lambda: self._readv_split(blockv))
+
+    def _readv_split(self, blockv):
+        # v1 vectors are limited to 255 segments by the request format
+        if len(blockv) <= 255:
+            return self._readv_single(blockv)
+        return bytearray().join(self._readv_single(blockv[i:i+255])
+                                for i in range(0, len(blockv), 255))
+
+    def _network(self, pooled, single):
+        if self._pool_size > 0:
+            try:
+                return self._with_connection(pooled)
+            except EOFError:
+                if self._proto >= 2:
+                    raise
+                # Servers predating persistent connections answer a single
+                # untagged request per connection
+                print("[-] BlockProxy: old block server, not pooling connections")
+                self._pool_size = 0
+        return single()
+
+    def _readv_single(self, blockv):
+        # One connection per request, as understood by all server versions
         count = 0
         for block in blockv:
             count += block[2]
         buf = bytearray(count)
-        VERBOSE
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             sock.connect((self.host, self.port))
             request = struct.pack('=BB', ord('v'), len(blockv))
             sock.sendall(request)
+            reader = _FrameReader(sock)
             boff = 0;
             for block in blockv:
-                self._read_network_buf(sock, buf, boff, block[0], block[1], block[2])
+                sock.sendall(self._encode_block(block))
+                self._read_network_buf(reader, buf, boff, block[1], block[2])
                 boff += block[2]
         finally:
             sock.close()
         return buf
 
-    def _read_network_buf(self, sock, buf, boff, dev_path, offset, count):
+    @staticmethod
+    def _encode_block(block):
+        enc_name = block[0].encode('utf8')
+        return struct.pack('=QQB', block[1], block[2], len(enc_name)) + enc_name
+
+    def _encode_request(self, tag, blockv):
+        request = bytearray(struct.pack('=BIBB', ord('T'), tag, ord('v'), len(blockv)))
+        for block in blockv:
+            request += self._encode_block(block)
+        return request
+
+    def _encode_request_v2(self, conn, tag, blockv):
+        request = bytearray(VECTOR_HDR.pack(ord('W'), tag, len(blockv)))
+        for block in blockv:
+            request += VECTOR_SEGMENT.pack(conn.devices[block[0]], block[1], block[2])
+        return request
+
+    def _pipeline(self, conn, blockvs):
+        # Sends the vectors as tagged requests without waiting for the
+        # replies in between. With v2 a vector is one request, v1 splits
+        # vectors longer than 255 segments into several.
+        if conn.proto >= 2:
+            conn.register_devices([block[0] for blockv in blockvs for block in blockv])
+            encode = lambda tag, blockv: self._encode_request_v2(conn, tag, blockv)
+            maxsegs = 0xffffffff
+        else:
+            # v1 vectors are limited to 255 segments by the request format
+            encode = self._encode_request
+            maxsegs = 255
+        reqs = []
+        for blockv in blockvs:
+            for i in range(0, max(len(blockv), 1), maxsegs):
+                reqs.append(blockv[i:i+maxsegs])
+        bufs = []
+        pending = []
+        inflight = 0
+        sent = 0
+        while sent < len(reqs) or pending:
+            # Keep the request window bounded so that neither side blocks
+            # sending while its peer is blocked too
+            while sent < len(reqs) and (not pending or inflight < PIPELINE_WINDOW):
+                tag = conn.new_tag()
+                request = encode(tag, reqs[sent])
+                conn.sock.sendall(request)
+                pending.append((tag, reqs[sent], len(request)))
+                inflight += len(request)
+                sent += 1
+            tag, blockv, reqlen = pending.pop(0)
+            inflight -= reqlen
+            bufs.append(self._read_tagged_reply(conn, tag, blockv))
+        # Reassemble vectors that were split into several requests
+        result = []
+        n = 0
+        for blockv in blockvs:
+            parts = max((len(blockv) + maxsegs - 1) // maxsegs, 1)
+            if parts == 1:
+                result.append(bufs[n])
+            else:
+                result.append(bytearray().join(bufs[n:n+parts]))
+            n += parts
+        return result
+
+    def _read_tagged_reply(self, conn, tag, blockv):
+        count = 0
+        for block in blockv:
+            count += block[2]
+        buf = bytearray(count)
+        boff = 0
+        for block in blockv:
+            self._read_network_buf(conn.reader, buf, boff, block[1], block[2], tag=tag)
+            boff += block[2]
+        return buf
+
+    def _read_network_buf(self, reader, buf, boff, offset, count, tag=None):
 
-        enc_name = dev_path.encode('utf8')
-        request = struct.pack('=QQB', offset, count, len(enc_name)) + enc_name;
-        sock.sendall(request)
-        
         view = memoryview(buf)
         while True:
-            answer = bytearray()
-            while len(answer) < 17:
-                answer += sock.recv(1)
-            a, off, l = struct.unpack('=BQQ', answer)
+            if tag is None:
+                a, off, l = reader.unpack(REPLY_HDR)
+            else:
+                a, rtag, off, l = reader.unpack(TAGGED_HDR)
+                if rtag != tag:
+                    raise IOError("Reply for request {} while expecting {}".format(rtag, tag))
             if a == ord('n'):
                 if VERBOSE:
                     print("[>] 'n' received");
                 if (count <= 0):
                     break;
                 count -= l;
-                while l > 0:
-                    nbytes = sock.recv_into(view[boff+(off-offset):], l)
-                    off += nbytes
-                    l -= nbytes
+                start = boff + (off - offset)
+                reader.read_into(view[start:start+l])
+            elif a == ord('z'):
+                # Zero run, the buffer is already zero-initialised
+                count -= l
+            elif a == ord('c'):
+                codec, clen = reader.unpack(COMPRESSED_HDR)
+                packed = bytearray(clen)
+                reader.read_into(memoryview(packed))
+                if codec == CODEC_LZ4:
+                    data = lz4block.decompress(packed, uncompressed_size=l)
+                else:
+                    data = zlib.decompress(packed)
+                if len(data) != l:
+                    raise IOError("Compressed chunk decodes to {} bytes instead of {}".format(len(data), l))
+                count -= l
+                start = boff + (off - offset)
+                view[start:start+l] = data
             elif a == ord('e'):
                 if VERBOSEERR:
                     print("[>] 'e' received");
-                break;
+                # Wait for the terminating 'l' to keep the stream in sync
+                continue
             elif a == ord('l'):
                 if VERBOSE:
                     print("[>] 'l' received");
@@ -144,30 +529,52 @@ class BlockProxy:
             
         # print("[+] BlockProxy: received {} bytes".format(len(buf)))
         
+    def _open_file(self, dev_path, idx):
+        dev_path_r = dev_path + (".%d" %(idx)) if self._use_1tb else dev_path
+        if dev_path_r in self._device_files:
+            return self._device_files[dev_path_r]
+        with self._pool_lock:
+            if dev_path_r not in self._device_files:
+                trans_path = dev_path
+                if trans_path in self._trans_table:
+                    trans_path = self._trans_table[trans_path]
+                    if self._use_1tb:
+                        trans_path = trans_path[idx]
+                f = open(trans_path, 'rb')
+                try:
+                    # Map each image once, reads become slices of the mapping
+                    view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                except (ValueError, OSError):
+                    # Empty files and some device nodes cannot be mapped
+                    view = None
+                holes = None
+                if hasattr(os, 'SEEK_DATA'):
+                    holes = _HoleMap(f.fileno(), os.fstat(f.fileno()).st_size)
+                self._device_files[dev_path_r] = (f, view, holes)
+        return self._device_files[dev_path_r]
+
     def _read_files(self, dev_path, offset, count):
-        idx = offset // (1024*1024*1024*1024)
         if self._use_1tb:
-            dev_path_r = dev_path + (".%d" %(idx))                    
-            offset = offset % (1024*1024*1024*1024)
+            idx = offset // PART_SIZE
+            offset = offset % PART_SIZE
+            if offset + count > PART_SIZE:
+                # The range continues in the next part
+                first = PART_SIZE - offset
+                data = bytearray(self._read_files(dev_path, idx * PART_SIZE + offset, first))
+                data += self._read_files(dev_path, (idx + 1) * PART_SIZE, count - first)
+                return data
         else:
-            dev_path_r = dev_path
-        if dev_path_r not in self._device_files:
-            trans_path = dev_path
-            if trans_path in self._trans_table:
-                trans_path = self._trans_table[trans_path]
-                if self._use_1tb:
-                    trans_path = trans_path[idx]
-            self._device_files[dev_path_r] = open(trans_path, 'rb')
-        f = self._device_files[dev_path_r]
-        f.seek(offset)
-        data = f.read(count)
-        return data
+            idx = 0
+        f, view, holes = self._open_file(dev_path, idx)
+        if holes is not None and holes.is_hole(offset, count):
+            # Holes in thin images read as zeros without touching the disk
+            return _zeros(count)
+        if view is not None:
+            return view[offset:offset+count]
+        return os.pread(f.fileno(), count, offset)
 
     def _readv_files(self, blockv):
-        data = bytearray()
-        for b in blockv:
-            data += self._read_files(b[0], b[1], b[2])
-        return data
+        return bytearray().join([self._read_files(b[0], b[1], b[2]) for b in blockv])
 
     def read_sectors(self, dev_path, sector, nsect):
         offset = sector * SECTOR_SIZE
@@ -36,83 +36,647 @@ Provides remote clients with access to the local disks.
 """
 
 from socketserver import TCPServer, BaseRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 import struct, socket
 import argparse
+import selectors
+import select
+import threading
+import os
+import zlib
+
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
 
 SERVER_ADDRESS = "localhost"
 SERVER_PORT = 24892
 
 trans_table = {}
 verbose = 0
+device_queues = None
+device_handles = None
+use_sendfile = False
 
 CHUNKSIZE=(4096*64)
+# Chunks read ahead of the one being sent on a connection
+READ_AHEAD = 8
+MAX_OPEN_DEVICES = 64
+MAX_CLIENTS = 256
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+RECV_BUFSIZE = 16*1024
 
-class BlockTCPHandler(BaseRequestHandler):
+OP_HDR = struct.Struct('=B')
+TAG_HDR = struct.Struct('=IB')
+READ_HDR = struct.Struct('=BQQB')
+SEGMENT_HDR = struct.Struct('=QQB')
+REPLY_HDR = struct.Struct('=BQQ')
+TAGGED_HDR = struct.Struct('=BIQQ')
 
-    def read_len(self,l):
-        buf = bytearray()
-        while (len(buf) < l):
-            buf += self.request.recv(1)
-        return buf
-    
+# Protocol v2
+PROTO_VERSION = 2
+HELLO_HDR = struct.Struct('=HI')
+HELLO_REPLY = struct.Struct('=BHI')
+DEVICE_HDR = struct.Struct('=H')
+DEVICE_REPLY = struct.Struct('=BI')
+VECTOR_HDR = struct.Struct('=II')
+VECTOR_SEGMENT = struct.Struct('=IQQ')
+COMPRESSED_HDR = struct.Struct('=BI')
+
+CAP_ZERO = 1        # all-zero chunks are sent as 'z' frames without payload
+CAP_ZLIB = 2        # chunks may be sent zlib-compressed in 'c' frames
+CAP_LZ4 = 4         # chunks may be sent LZ4-compressed in 'c' frames
+CAP_IDLE = 8        # idle connections hold no server thread and may be kept open
+SERVER_CAPS = CAP_ZERO | CAP_ZLIB | CAP_IDLE | (CAP_LZ4 if lz4block else 0)
+
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+BAD_DEVICE = 0xffffffff
+ZERO_CHUNK = bytes(CHUNKSIZE)
+
+
+class DeviceHandles:
+    """
+    LRU cache of open device descriptors keyed by translated path, together
+    with the device sizes. Descriptors are only read with positional reads,
+    so they can be shared between threads.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_DEVICES):
+        self._max_open = max_open
+        self._fds = OrderedDict()
+        self._refs = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        with self._lock:
+            if path in self._fds:
+                self._fds.move_to_end(path)
+                fd = self._fds[path]
+            else:
+                fd = os.open(path, os.O_RDONLY)
+                if path not in self._sizes:
+                    self._sizes[path] = os.lseek(fd, 0, os.SEEK_END)
+                self._fds[path] = fd
+                self._evict()
+            self._refs[fd] = self._refs.get(fd, 0) + 1
+            return fd, self._sizes[path]
+
+    def release(self, fd):
+        with self._lock:
+            self._refs[fd] -= 1
+            if self._refs[fd] == 0:
+                del self._refs[fd]
+                if fd not in self._fds.values():
+                    os.close(fd)
+
+    def preload(self, paths):
+        # Learn the device sizes once at startup
+        for path in paths:
+            try:
+                fd, size = self.acquire(path)
+                self.release(fd)
+                if verbose:
+                    print("[+] Device {}: {} bytes".format(path, size))
+            except OSError as e:
+                print("[-] Block Server: cannot open {} ({})".format(path, e))
+
+    def _evict(self):
+        # Descriptors still in use are closed on their last release
+        while len(self._fds) > self._max_open:
+            path, fd = self._fds.popitem(last=False)
+            if fd not in self._refs:
+                os.close(fd)
+
+
+class DeviceQueue:
+    """
+    Bounded I/O queue in front of a single device. Each device gets its own
+    reader threads so that reads to different disks proceed in parallel.
+    """
+
+    def __init__(self, depth, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=depth)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args):
+        # Blocks the submitter once too many reads are queued for the device
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(func, *args)
+        except:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda f: self._pending.release())
+        return future
+
+
+class DeviceQueues:
+
+    def __init__(self, depth, max_pending):
+        self._depth = depth
+        self._max_pending = max_pending
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, path):
+        with self._lock:
+            if path not in self._queues:
+                self._queues[path] = DeviceQueue(self._depth, self._max_pending)
+            return self._queues[path]
+
+
+class BlockServer(TCPServer):
+    """
+    TCP server that waits for requests on all open connections at once.
+    Connections with requests pending are handed to a pool of worker
+    threads, or served in the server thread when there are no workers.
+    Idle connections hold no thread. Past max_clients open connections the
+    longest idle one is closed for every new one, clients reconnect when
+    they need it again.
+    """
+
+    def __init__(self, server_address, handler, workers=0, max_clients=MAX_CLIENTS):
+        super().__init__(server_address, handler)
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._max_clients = max_clients
+        self._clients = 0
+        self._accepting = True
+        # Connections waiting for requests, the longest idle first
+        self._idle = OrderedDict()
+        self._selector = selectors.DefaultSelector()
+        # Workers hand the connections they served back to the server thread
+        self._served = deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        self._selector.register(self.socket, selectors.EVENT_READ, None)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup_r)
+        self._accepting = True
+        try:
+            while not self._shutdown_request:
+                self._serve_events(poll_interval)
+                self.service_actions()
+        finally:
+            if self._accepting:
+                self._selector.unregister(self.socket)
+            self._selector.unregister(self._wakeup_r)
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """
+        Stops serve_forever() and waits until it returned. Must be called
+        from another thread.
+        """
+        self._shutdown_request = True
+        self._wakeup_w.send(b'.')
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        """
+        Closes the listening socket and all client connections, after the
+        workers have finished the requests they are serving.
+        """
+        super().server_close()
+        if self._executor is not None:
+            self._executor.shutdown()
+        while self._served:
+            self._close(self._served.popleft()[0])
+        for conn in self._idle:
+            self._close(conn)
+        self._idle.clear()
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _serve_events(self, poll_interval):
+        for key, events in self._selector.select(poll_interval):
+            if key.data is None:
+                self._accept()
+            elif key.data is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                while self._served:
+                    self._requeue(*self._served.popleft())
+            else:
+                # Nobody else waits on the connection while it is served
+                self._selector.unregister(key.fileobj)
+                del self._idle[key.data]
+                if self._executor is None:
+                    self._requeue(key.data, self._serve(key.data))
+                else:
+                    self._executor.submit(self._serve_worker, key.data)
+
+    def _accept(self):
+        if self._clients >= self._max_clients:
+            if not self._idle:
+                # All connections are busy, accept once one of them is done
+                self._selector.unregister(self.socket)
+                self._accepting = False
+                return
+            conn, _ = self._idle.popitem(last=False)
+            self._selector.unregister(conn.request)
+            self._close(conn)
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            return
+        try:
+            conn = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self._clients += 1
+        self._wait(conn)
+
+    def _serve(self, conn):
+        try:
+            return conn.handle()
+        except Exception:
+            self.handle_error(conn.request, conn.client_address)
+            return False
+
+    def _serve_worker(self, conn):
+        self._served.append((conn, self._serve(conn)))
+        self._wakeup_w.send(b'.')
+
+    def _requeue(self, conn, alive):
+        if alive:
+            self._wait(conn)
+        else:
+            self._close(conn)
+        if not self._accepting:
+            self._selector.register(self.socket, selectors.EVENT_READ, None)
+            self._accepting = True
+
+    def _wait(self, conn):
+        self._selector.register(conn.request, selectors.EVENT_READ, conn)
+        self._idle[conn] = None
+
+    def _close(self, conn):
+        self.shutdown_request(conn.request)
+        self._clients -= 1
+
+class RequestReader:
+    """
+    Buffered reader for the request stream. Fixed-size request headers are
+    parsed in place, so a request costs one recv call instead of one per byte.
+    """
+
+    def __init__(self, sock, bufsize=RECV_BUFSIZE):
+        self._sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self, n):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._start + n > len(self._buf):
+            avail = self._end - self._start
+            self._view[:avail] = self._view[self._start:self._end]
+            self._start, self._end = 0, avail
+        while self._end - self._start < n:
+            nbytes = self._sock.recv_into(self._view[self._end:])
+            if nbytes == 0:
+                raise EOFError()
+            self._end += nbytes
+
+    def unpack(self, fmt):
+        self._fill(fmt.size)
+        values = fmt.unpack_from(self._buf, self._start)
+        self._start += fmt.size
+        return values
+
+    def buffered(self):
+        return self._end - self._start
+
+    def read(self, n):
+        self._fill(n)
+        data = bytes(self._view[self._start:self._start+n])
+        self._start += n
+        return data
+
+
+class BlockTCPHandler(BaseRequestHandler):
     """
     Request handler for the block server
+
+    Connections are kept open until the client closes them. The server calls
+    handle() whenever requests arrive on a connection. Requests prefixed with
+    'T' and a request ID are answered with frames carrying that ID.
+
+    Protocol v2 clients start with an 'H' handshake that negotiates the
+    capabilities, register their devices once per connection with 'D' and
+    send vector reads as 'W' requests that refer to the devices by ID.
     """
+    def __init__(self, request, client_address, server):
+        # Set up once per connection, handle() runs for every batch of requests
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = RequestReader(self.request)
+        self.caps = 0
+        self.devices = []
+
     def handle(self):
-        cmd = self.read_len(1)
-        op = cmd[0]
-        if op == ord('r'):
-            self.handle_read_block(cmd)
-        elif op == ord('v'):
-            self.handle_read_blockv(cmd)
+        """
+        Serves the requests that arrived on the connection. Returns False
+        once the connection is closed.
+        """
+        while True:
+            self.tag = None
+            try:
+                op, = self.reader.unpack(OP_HDR)
+            except (EOFError, ConnectionError):
+                return False
+            if op == ord('T'):
+                self.tag, op = self.reader.unpack(TAG_HDR)
+            if op == ord('r'):
+                self.handle_read_block()
+            elif op == ord('v'):
+                self.handle_read_blockv()
+            elif op == ord('W'):
+                self.handle_read_blockw()
+            elif op == ord('H'):
+                self.handle_hello()
+            elif op == ord('D'):
+                self.handle_device()
+            else:
+                print("[-] Block Server: invalid request %s" %(str(op)) )
+                return False
+            if not self.reader.buffered() and not _readable(self.request):
+                # Nothing more to do until the client sends another request
+                return True
+
+    def send_header(self, code, offset, length, more=False):
+        if self.tag is None:
+            hdr = REPLY_HDR.pack(code, offset, length)
+        else:
+            hdr = TAGGED_HDR.pack(code, self.tag, offset, length)
+        if more and MSG_MORE:
+            # Let the kernel put the header in the same segment as the data
+            self.request.sendall(hdr, MSG_MORE)
+        else:
+            self.request.sendall(hdr)
+
+    def handle_read_block(self):
+        pad, offset, count, pathlen = self.reader.unpack(READ_HDR)
+        path = self.reader.read(pathlen).decode('utf8')
+        self._send_segments([(path, offset, count)])
+
+    def handle_read_blockv(self):
+        nreqs, = self.reader.unpack(OP_HDR)
+        if self.tag is None:
+            # Untagged clients wait for each reply before sending the next segment
+            for n in range(nreqs):
+                self._send_segments([self._read_segment_request()])
         else:
-            print("[-] Block Server: invalid request %s" %(str(op)) )
+            self._send_segments([self._read_segment_request() for n in range(nreqs)])
 
-    def handle_read_block(self, cmd):
-        cmd = self.read_len(1+8+8+1)
-        pad, offset, count, pathlen = struct.unpack('=BQQB', cmd)
-        path = self.read_len(pathlen).decode('utf8')
-        self._do_read(path, offset, count)
+    def handle_hello(self):
+        version, caps = self.reader.unpack(HELLO_HDR)
+        self.caps = caps & SERVER_CAPS
+        self.request.sendall(HELLO_REPLY.pack(ord('h'), min(version, PROTO_VERSION), self.caps))
 
-    def handle_read_blockv(self, cmd):
-        cmd = self.read_len(1)
-        nreqs, = struct.unpack('=B', cmd)
+    def handle_device(self):
+        pathlen, = self.reader.unpack(DEVICE_HDR)
+        path = self.reader.read(pathlen).decode('utf8')
+        if len(self.devices) < BAD_DEVICE:
+            devid = len(self.devices)
+            self.devices.append(path)
+        else:
+            devid = BAD_DEVICE
+        self.request.sendall(DEVICE_REPLY.pack(ord('d'), devid))
+
+    def handle_read_blockw(self):
+        self.tag, nreqs = self.reader.unpack(VECTOR_HDR)
+        segments = []
         for n in range(nreqs):
-            cmd = self.read_len(8+8+1)
-            (offset, count, pathlen) = struct.unpack('=QQB', cmd)
-            path = self.read_len(pathlen).decode('utf8')
-            self._do_read(path, offset, count)
-
-    def _do_read(self, path, offset, count):
-        if path in trans_table.keys():
-            path = trans_table[path]
-        if verbose:
-            print("[+] Block server: {} -- {}/{}".format(path, offset, count))
-        try:
-            f = open(path, 'rb')
+            devid, offset, count = self.reader.unpack(VECTOR_SEGMENT)
+            # Unknown IDs map to a path that cannot be opened and read as errors
+            path = self.devices[devid] if devid < len(self.devices) else ''
+            segments.append((path, offset, count))
+        self._send_segments(segments)
+
+    def send_chunk(self, offset, data):
+        l = len(data)
+        # Chunks are at most CHUNKSIZE long. startswith() compares the
+        # buffer in place, slicing ZERO_CHUNK would copy it.
+        if self.caps & CAP_ZERO and ZERO_CHUNK.startswith(data):
+            self.send_header(ord('z'), offset, l) # 'z' zero packet
+            return
+        if self.caps & (CAP_LZ4 | CAP_ZLIB):
+            if self.caps & CAP_LZ4:
+                codec = CODEC_LZ4
+                packed = lz4block.compress(data, store_size=False)
+            else:
+                codec = CODEC_ZLIB
+                packed = zlib.compress(data, 1)
+            # Only worth it when the chunk shrinks noticeably
+            if len(packed) < l - l // 8:
+                self.send_header(ord('c'), offset, l, more=True) # 'c' compressed packet
+                self.request.sendall(COMPRESSED_HDR.pack(codec, len(packed)), MSG_MORE)
+                self.request.sendall(packed)
+                return
+        self.send_header(ord('n'), offset, l, more=True) # 'n' next packet
+        self.request.sendall(data)
 
-            f.seek(0,2)
-            sz = f.tell();
+    def _read_segment_request(self):
+        (offset, count, pathlen) = self.reader.unpack(SEGMENT_HDR)
+        path = self.reader.read(pathlen).decode('utf8')
+        return path, offset, count
+
+    def _send_segments(self, segments):
+        if use_sendfile:
+            self._sendfile_segments(segments)
+            return
+        # The segments are read in chunks, up to READ_AHEAD of them queued on
+        # the devices ahead of the one being sent. Segments on different
+        # devices are read concurrently and the memory used stays bounded.
+        stopped = set()
+        chunks = _split_chunks(segments, stopped)
+        queue = deque()
+        for n, (path, offset, count) in enumerate(segments):
             if verbose:
-                print(("disk size: %d" % (sz)))
-            
-            i = 0;
-            while i < count:
-                l = min(count-i, CHUNKSIZE)
-                f.seek(offset)
-                data = f.read(l)
-                self.request.sendall(struct.pack('=BQQ', ord('n'), offset, len(data))) # 'n' next packet
-                self.request.sendall(data)
-                i += l
-                offset += l
-            f.close()
-        except Exception as e:
+                print("[+] Block server: {} -- {}/{}".format(_translate(path), offset, count))
+            i = 0
+            error = False
+            while True:
+                while len(queue) < READ_AHEAD:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    queue.append((chunk[0], chunk[3], _submit_read(*chunk[1:])))
+                if not queue or queue[0][0] != n:
+                    break
+                m, l, result = queue.popleft()
+                if n in stopped:
+                    # Read ahead before the segment came up short
+                    continue
+                data, error = result()
+                if len(data):
+                    self.send_chunk(offset + i, data)
+                    i += len(data)
+                if error or len(data) < l:
+                    stopped.add(n)
+            if error:
+                self.send_header(ord('e'), offset + i, 0) # 'e' error
+            self.send_header(ord('l'), offset + i, count) # 'l' last 
             if verbose:
-                print(str(e))
-            self.request.sendall(struct.pack('=BQQ', ord('e'), offset, 0 )) # 'e' error
-        self.request.sendall(struct.pack('=BQQ', ord('l'),offset, count)) # 'l' last 
+                print("[+]  Read {} bytes".format(i))
+
+
+    def _sendfile_segments(self, segments):
+        """
+        Ships the device ranges straight from the page cache to the socket.
+        The framing is the same as for buffered reads.
+        """
+        handles = []
+        try:
+            for path, offset, count in segments:
+                try:
+                    fd, sz = device_handles.acquire(_translate(path))
+                except Exception as e:
+                    if verbose:
+                        print(str(e))
+                    handles.append(None)
+                    continue
+                handles.append((fd, sz))
+                # Start the reads on all devices before sending the first range
+                if hasattr(os, 'posix_fadvise') and offset < sz:
+                    os.posix_fadvise(fd, offset, min(count, sz - offset), os.POSIX_FADV_WILLNEED)
+            for (path, offset, count), handle in zip(segments, handles):
+                error = handle is None
+                i = 0
+                if not error:
+                    fd, sz = handle
+                    total = max(min(count, sz - offset), 0)
+                    while i < total:
+                        l = min(total-i, CHUNKSIZE)
+                        self.send_header(ord('n'), offset + i, l, more=True) # 'n' next packet
+                        n = self._sendfile(fd, _translate(path), offset + i, l)
+                        if n < l:
+                            # The header promised l bytes, keep the stream in sync
+                            self.request.sendall(bytes(l - n))
+                            error = True
+                            break
+                        i += l
+                if error:
+                    self.send_header(ord('e'), offset + i, 0) # 'e' error
+                self.send_header(ord('l'), offset + i, count) # 'l' last 
+                if verbose:
+                    print("[+]  Sent {} bytes".format(i))
+        finally:
+            for handle in handles:
+                if handle is not None:
+                    device_handles.release(handle[0])
+
+    def _sendfile(self, fd, path, offset, count):
+        sent = 0
+        if hasattr(os, 'sendfile'):
+            sockno = self.request.fileno()
+            while sent < count:
+                n = os.sendfile(sockno, fd, offset + sent, count - sent)
+                if n == 0:
+                    break
+                sent += n
+        else:
+            # socket.sendfile() seeks, so it needs a file object of its own
+            with open(path, 'rb') as f:
+                sent = self.request.sendfile(f, offset, count)
+        return sent
+
+
+def _readable(sock):
+    # Returns whether a request or EOF waits on sock. select() fails on
+    # descriptors past FD_SETSIZE, which a server with many clients reaches,
+    # poll() has no such limit.
+    if not hasattr(select, 'poll'):
+        return bool(select.select([sock], [], [], 0)[0])
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(0))
+
+
+def _translate(path):
+    return trans_table.get(path, path)
+
+
+def _split_chunks(segments, stopped):
+    # Yields (segment index, path, offset, count) for every chunk of the
+    # segments, skipping the rest of the segments in stopped
+    for n, (path, offset, count) in enumerate(segments):
+        path = _translate(path)
+        for i in range(0, count, CHUNKSIZE):
+            if n in stopped:
+                break
+            yield n, path, offset + i, min(count - i, CHUNKSIZE)
+
+
+def _submit_read(path, offset, count):
+    # Returns a function that waits for the chunk and returns _read_chunk()'s result
+    if device_queues is None:
+        result = _read_chunk(path, offset, count)
+        return lambda: result
+    return device_queues[path].submit(_read_chunk, path, offset, count).result
+
+
+def _read_chunk(path, offset, count):
+    """
+    Reads a chunk of a device, reads past its end come back short. Returns
+    the data and whether the read failed.
+    """
+    try:
+        fd, sz = device_handles.acquire(path)
+    except Exception as e:
+        if verbose:
+            print(str(e))
+        return b'', True
+    try:
+        count = max(min(count, sz - offset), 0)
+        buf = bytearray(count)
+        view = memoryview(buf)
+        i = 0
+        while i < count:
+            n = _pread_into(fd, view[i:], offset + i)
+            if n <= 0:
+                break
+            i += n
+        return view[:i], False
+    except Exception as e:
         if verbose:
-            print("[+]  Read {} bytes".format(i))
+            print(str(e))
+        return b'', True
+    finally:
+        device_handles.release(fd)
+
+
+if hasattr(os, 'preadv'):
+    def _pread_into(fd, view, offset):
+        return os.preadv(fd, [view], offset)
+else:
+    def _pread_into(fd, view, offset):
+        data = os.pread(fd, len(view), offset)
+        view[:len(data)] = data
+        return len(data)
 
 def populate_trans_table(args):
     global trans_table
@@ -131,10 +695,27 @@ if __name__ == "__main__":
     parser.add_argument('--verbose', '-v', dest='verbose', action='count', default=0)
     parser.add_argument('--config', '-c', dest='config', type=str, default="disks.tab",
                         help='Configuration file in json format, default disks.tab')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=8,
+                        help='Threads serving requests, 0 serves them one at a time from the main '
+                             'thread, default 8')
+    parser.add_argument('--max-clients', dest='max_clients', type=int, default=MAX_CLIENTS,
+                        help='Open connections before idle ones get closed, default {}'.format(MAX_CLIENTS))
+    parser.add_argument('--queue-depth', '-q', dest='queue_depth', type=int, default=2,
+                        help='Concurrent reads per device, default 2')
+    parser.add_argument('--max-pending', dest='max_pending', type=int, default=64,
+                        help='Reads queued per device before clients are throttled, default 64')
+    parser.add_argument('--sendfile', '-s', dest='sendfile', action='store_true',
+                        help='Send device data with sendfile() instead of reading it into memory')
     args = parser.parse_args()
     verbose = args.verbose
+    use_sendfile = args.sendfile
     
     populate_trans_table(args)
+    device_handles = DeviceHandles()
+    device_handles.preload(trans_table.values())
     TCPServer.allow_reuse_address = True
-    server = TCPServer((SERVER_ADDRESS, SERVER_PORT), BlockTCPHandler)
+    if args.workers > 0:
+        device_queues = DeviceQueues(args.queue_depth, args.max_pending)
+    server = BlockServer((SERVER_ADDRESS, SERVER_PORT), BlockTCPHandler,
+                         args.workers, args.max_clients)
     server.serve_forever()
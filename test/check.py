@@ -0,0 +1,196 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Self-contained checks of the raidz parity reconstruction and the raidz
+column maps. No test disks or loop devices are needed, run it with
+python3 check.py. The other check_*.py scripts use
+expect() and run() from here.
+"""
+
+import itertools
+import os
+import random
+import sys
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, TOP)
+
+from zfs import raidz
+from zfs.zio import RaidzDevice, roundup
+
+
+class CheckFailed(Exception):
+    pass
+
+def expect(cond, msg):
+    if not cond:
+        raise CheckFailed(msg)
+
+def random_bytes(rnd, n):
+    return rnd.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+
+
+# Raidz reconstruction, against parity computed one byte at a time like the
+# kernel does: Q and R by Horner's rule, multiplying by 2 with the 0x1d
+# feedback of the generator polynomial.
+
+def _mul2(col):
+    return bytes(((x << 1) ^ (0x1d if x & 0x80 else 0)) & 0xff for x in col)
+
+def _xor(a, b):
+    return bytes(x ^ y for x, y in zip(a, b))
+
+def _gen_parity(data_cols, nparity, size):
+    cols = [c + bytes(size - len(c)) for c in data_cols]
+    parity = []
+    for p in range(nparity):
+        acc = bytes(size)
+        for c in cols:
+            # P, Q and R multiply by 1, 2 and 4
+            for i in range(p):
+                acc = _mul2(acc)
+            acc = _xor(acc, c)
+        parity.append(acc)
+    return parity
+
+def check_raidz():
+    rnd = random.Random(18)
+    combos = 0
+    for nparity in range(1, 4):
+        for ndata in range(1, 7):
+            # Big columns hold one sector more than the others
+            sector = 32
+            q = rnd.randint(1, 3)
+            bc = rnd.randint(0, ndata)
+            sizes = [(q + (1 if c < bc else 0)) * sector for c in range(ndata)]
+            data = [random_bytes(rnd, s) for s in sizes]
+            cols = _gen_parity(data, nparity, sizes[0]) + data
+            for k in range(1, nparity + 1):
+                for missing in itertools.combinations(range(len(cols)), k):
+                    damaged = [random_bytes(rnd, len(c)) if n in missing else c
+                               for n, c in enumerate(cols)]
+                    rebuilt = raidz.reconstruct(damaged, nparity, list(missing))
+                    expect(rebuilt is not None, "raidz{} with {} data columns: cannot rebuild columns {}".format(
+                        nparity, ndata, missing))
+                    expect([bytes(c) for c in rebuilt[nparity:]] == data,
+                           "raidz{} with {} data columns: columns {} rebuilt wrong".format(nparity, ndata, missing))
+                    combos += 1
+            if ndata > nparity:
+                lost = list(range(nparity, 2 * nparity + 1))
+                expect(raidz.reconstruct(cols, nparity, lost) is None,
+                       "raidz{}: {} bad data columns not refused".format(nparity, len(lost)))
+    return "{} combinations of bad columns rebuilt".format(combos)
+
+
+# Column maps, against a copy of the original raidz1 map generalised by
+# vdev_raidz_map_alloc() of the kernel
+
+def _baseline_map(dcols, nparity, io_offset, io_size, unit_shift):
+    b = io_offset >> unit_shift
+    s = io_size >> unit_shift
+    f = b % dcols
+    o = (b // dcols) << unit_shift
+    q = s // (dcols - nparity)
+    r = s - q * (dcols - nparity)
+    bc = (r + nparity) if r else 0
+    if q == 0:
+        acols = bc
+        scols = min(dcols, roundup(bc, nparity + 1))
+    else:
+        acols = dcols
+        scols = dcols
+    skipstart = bc
+    cols = []
+    for c in range(scols):
+        col = f + c
+        coff = o
+        if col >= dcols:
+            col -= dcols
+            coff += (1 << unit_shift)
+        if c >= acols:
+            size = 0
+        elif c < bc:
+            size = (q + 1) << unit_shift
+        else:
+            size = q << unit_shift
+        if size > 0:
+            cols.append([col, coff, size])
+    if nparity == 1 and (io_offset & (1 << 20)):
+        cols[0][0], cols[1][0] = cols[1][0], cols[0][0]
+        cols[0][1], cols[1][1] = cols[1][1], cols[0][1]
+        if skipstart == 0:
+            skipstart = 1
+    return tuple(tuple(c) for c in cols), nparity, skipstart
+
+def check_column_maps():
+    rnd = random.Random(18)
+    maps = 0
+    for nparity in range(1, 4):
+        for dcols in range(nparity + 1, nparity + 9):
+            for ashift in (9, 12):
+                dev = RaidzDevice(["/dev/c{}".format(i) for i in range(dcols)], nparity, ("localhost", 0),
+                                  ashift=ashift)
+                for n in range(300):
+                    offset = rnd.randrange(0, 1 << 34) >> ashift << ashift
+                    size = rnd.randint(1, 288) << ashift
+                    got = dev._map_alloc(offset, size, ashift)
+                    want = _baseline_map(dcols, nparity, offset, size, ashift)
+                    expect(got == want, "raidz{} over {} disks, ashift {}: map of {}:{} is {} instead of {}".format(
+                        nparity, dcols, ashift, hex(offset), hex(size), got, want))
+                    maps += 1
+    return "{} maps match".format(maps)
+
+
+def run(checks):
+    """
+    Runs the (name, function) pairs of checks and exits with 1 if any of
+    them failed. A check returns a summary or raises CheckFailed.
+    """
+    failed = 0
+    for name, check in checks:
+        try:
+            print("[+] {}: {}".format(name, check()))
+        except CheckFailed as e:
+            print("[-] {}: {}".format(name, e))
+            failed += 1
+    if failed:
+        print("[-] {} of {} checks failed".format(failed, len(checks)))
+        sys.exit(1)
+    print("[+] All checks passed")
+
+
+CHECKS = [
+    ("raidz reconstruction", check_raidz),
+    ("raidz column maps", check_column_maps),
+]
+
+
+if __name__ == "__main__":
+    run(CHECKS)
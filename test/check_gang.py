@@ -0,0 +1,89 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Checks the verifier of gang block headers: good headers are accepted,
+tampered ones and ones read for a block at another location or of another
+birth are rejected.
+"""
+
+import struct
+from hashlib import sha256
+
+from check import expect, run
+
+from zfs.blockptr import BlockPtr, GangHeader, GANG_TAIL_SIZE, ZEC_MAGIC
+
+
+def _bptr(vdev, offset, asize, psize, birth, gang=False):
+    words = [0] * 16
+    words[0] = (vdev << 32) | ((asize >> 9) & 0xffffff)
+    words[1] = (offset >> 9) | ((1 << 63) if gang else 0)
+    # Uncompressed, fletcher4, plain file contents
+    words[6] = ((psize >> 9) - 1) | (((psize >> 9) - 1) << 16) | (2 << 32) | (7 << 40) | (19 << 48) | (1 << 63)
+    words[9] = birth
+    words[11] = 1
+    return struct.pack('<16Q', *words)
+
+def _gang_header(size, vdev, offset, birth, members):
+    tail = size - GANG_TAIL_SIZE
+    hdr = bytearray(size)
+    for i, m in enumerate(members):
+        hdr[i*128:(i+1)*128] = m
+    struct.pack_into('<Q', hdr, tail, ZEC_MAGIC)
+    struct.pack_into('<4Q', hdr, tail + 8, vdev, offset, birth, 0)
+    struct.pack_into('<4Q', hdr, tail + 8, *struct.unpack('>4Q', sha256(hdr).digest()))
+    return bytes(hdr)
+
+def check_gang_headers():
+    checked = 0
+    for size, nmembers in ((512, 3), (4096, 31)):
+        members = [_bptr(1, 0x10000 * (i + 1), 4096, 4096, 77) for i in range(nmembers)]
+        hdr = _gang_header(size, 1, 0x2000, 77, members)
+        bptr = BlockPtr(_bptr(1, 0x2000, size, 512 * nmembers, 77, gang=True))
+        header = GangHeader(hdr, bptr)
+        expect(header.valid, "{} byte header rejected".format(size))
+        expect([m.get_dva(0).offset for m in header.bptrs] == [0x10000 * (i + 1) for i in range(nmembers)],
+               "{} byte header lists the wrong members".format(size))
+        tampered = bytearray(hdr)
+        tampered[130] ^= 1
+        expect(not GangHeader(bytes(tampered), bptr).valid, "tampered {} byte header accepted".format(size))
+        moved = BlockPtr(_bptr(1, 0x4000, size, 512 * nmembers, 77, gang=True))
+        expect(not GangHeader(hdr, moved).valid, "{} byte header accepted at another offset".format(size))
+        reborn = BlockPtr(_bptr(1, 0x2000, size, 512 * nmembers, 78, gang=True))
+        expect(not GangHeader(hdr, reborn).valid, "{} byte header accepted with another birth".format(size))
+        other_vdev = BlockPtr(_bptr(0, 0x2000, size, 512 * nmembers, 77, gang=True))
+        expect(not GangHeader(hdr, other_vdev).valid, "{} byte header accepted on another vdev".format(size))
+        expect(not GangHeader(bytes(size), bptr).valid, "empty {} byte header accepted".format(size))
+        checked += 1
+    return "{} header sizes verified, tampered and relocated ones rejected".format(checked)
+
+
+if __name__ == "__main__":
+    run([("gang block headers", check_gang_headers)])
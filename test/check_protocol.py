@@ -0,0 +1,128 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Checks the block server protocol against a server running in this process:
+v2 reads with every compression the server offers, vectors longer than a
+v1 request allows, and the fallback of BlockProxy to servers that only
+speak v1.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import threading
+from socket import SHUT_RDWR
+
+from check import TOP, expect, run, random_bytes
+
+sys.path.insert(0, os.path.join(TOP, 'block_server'))
+
+from block_proxy.proxy import BlockProxy, CAP_IDLE, CAP_ZLIB, CAP_LZ4
+import server
+
+
+class V1Handler(server.BlockTCPHandler):
+    """
+    Answers like a server predating protocol v2, which drops the connection
+    on an 'H' request.
+    """
+    def handle_hello(self):
+        self.reader.unpack(server.HELLO_HDR)
+        self.request.shutdown(SHUT_RDWR)
+
+def _start_server(handler):
+    srv = server.BlockServer(("localhost", 0), handler, workers=2)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.start()
+    return srv, thread
+
+def _stop_server(srv, thread):
+    srv.shutdown()
+    thread.join()
+    srv.server_close()
+
+def _check_reads(handler, images, compression):
+    rnd = random.Random(18)
+    srv, thread = _start_server(handler)
+    bp = BlockProxy(("localhost", srv.server_address[1]), compression=compression)
+    try:
+        for n in range(12):
+            # Vectors of more than 255 segments are split for v1 servers
+            nsegs = rnd.choice((1, 5, 300))
+            blockv = []
+            for i in range(nsegs):
+                path = rnd.choice(list(images))
+                offset = rnd.randrange(0, len(images[path]) - 1)
+                count = rnd.randint(1, min(len(images[path]) - offset, (1 << 21) // nsegs))
+                blockv.append((path, offset, count))
+            got = bytes(bp.readv(blockv))
+            want = b''.join(images[p][o:o+c] for p, o, c in blockv)
+            expect(got == want, "{} segments read wrong with compression {}".format(len(blockv), compression))
+        return bp._proto, bp._pool[0][0].caps if bp._pool else 0
+    finally:
+        # Connections still pooled by the proxy are closed by the server
+        _stop_server(srv, thread)
+        bp.close()
+
+def check_protocol():
+    rnd = random.Random(18)
+    server.device_handles = server.DeviceHandles()
+    server.device_queues = server.DeviceQueues(2, 64)
+    tmp = tempfile.TemporaryDirectory()
+    images = {}
+    for i in range(3):
+        path = "/dev/c{}".format(i)
+        # Runs of zeros for the 'z' frames, text for the compressed ones
+        data = bytearray(random_bytes(rnd, 1 << 20))
+        data += bytes(1 << 20)
+        data += b"zfs rescue " * 100000
+        images[path] = bytes(data)
+        server.trans_table[path] = os.path.join(tmp.name, "c{}.bin".format(i))
+        with open(server.trans_table[path], "wb") as f:
+            f.write(data)
+    try:
+        codecs = [(None, 0), ("zlib", CAP_ZLIB)]
+        if server.lz4block is not None:
+            codecs.append(("lz4", CAP_LZ4))
+        for compression, cap in codecs:
+            proto, caps = _check_reads(server.BlockTCPHandler, images, compression)
+            expect(proto == 2, "protocol {} instead of 2 with compression {}".format(proto, compression))
+            expect(caps & CAP_IDLE and (caps & cap) == cap,
+                   "capabilities {} with compression {}".format(caps, compression))
+        proto, caps = _check_reads(V1Handler, images, "zlib")
+        expect(proto == 1, "no fallback to protocol 1")
+    finally:
+        tmp.cleanup()
+    return "v2 reads with compression {}, fallback to v1".format(", ".join(str(c) for c, cap in codecs))
+
+
+if __name__ == "__main__":
+    run([("block server protocol", check_protocol)])
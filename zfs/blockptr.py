@@ -29,9 +29,15 @@
 
 import struct
 from zfs.obj_desc import *
+from zfs.checksum import fletcher4, sha256
 
 VERBOSE_EMBED=False
 
+# Gang block headers hold block pointers followed by a zio_eck_t trailer
+GANG_HEADER_SIZE = 512
+GANG_TAIL_SIZE = 40
+ZEC_MAGIC = 0x210da7ab10c7a11
+
 class DVA:
 
     def __init__(self, qword0, qword1):
@@ -76,6 +82,7 @@ class BlockPtr:
         self._lvl = None
         self._E = None
         self._birth_txg = None
+        self._phys_birth_txg = None
         self._fill_count = None
         self._checksum = None
         self._encrypted = None
@@ -96,6 +103,7 @@ class BlockPtr:
         self._lvl = (qwords[6] >> 56) & 0x7f
         self._encrypted = (qwords[6] >> 61) & 0x1;
         self._E = qwords[6] >> 63
+        self._phys_birth_txg = qwords[9]
         self._birth_txg = qwords[10]
         self._fill_count = qwords[11]
         self._checksum = qwords[12:16]
@@ -188,20 +196,53 @@ class BlockPtrArray:
     def __getitem__(self, item):
         return self._bptrs[item]
 
-def fletcher4(data):
-    l = len(data)
-    e = ( 4 - (l % 4) ) % 4;
-    if (e > 0):
-        data = data + ([0]*e);
-        l += e
-    a = 0
-    b = 0
-    c = 0
-    d = 0
-    for i in range(l//4):
-        v, = struct.unpack("<I",data[i*4:(i+1)*4])
-        a += v
-        b += a
-        c += b
-        d += c
-    return (a&0xffffffffffffffff,b&0xffffffffffffffff,c&0xffffffffffffffff,d&0xffffffffffffffff)
+
+class GangHeader:
+    """
+    The header of a gang block. Lists the blocks whose physical data,
+    concatenated, make up the physical data of the gang block.
+    """
+
+    def __init__(self, data, bptr):
+        self._bptrs = []
+        self._valid = False
+        # Headers are 512 bytes, or a whole sector with dynamic gang headers
+        for size in (GANG_HEADER_SIZE, len(data)):
+            if size <= len(data) and self._parse(data[0:size], bptr):
+                break
+
+    def _parse(self, data, bptr):
+        tail = len(data) - GANG_TAIL_SIZE
+        magic, = struct.unpack_from("<Q", data, tail)
+        if magic == ZEC_MAGIC:
+            fmt = "<4Q"
+        elif magic == struct.unpack("<Q", struct.pack(">Q", ZEC_MAGIC))[0]:
+            fmt = ">4Q"
+        else:
+            return False
+        # The checksum is computed with the verifier, the location and birth
+        # of the first DVA, in place of the stored checksum
+        dva = bptr.get_dva(0)
+        birth = bptr._phys_birth_txg or bptr._birth_txg
+        expect = struct.unpack_from(fmt, data, tail + 8)
+        data = bytearray(data)
+        struct.pack_into(fmt, data, tail + 8, dva._vdev, dva.offset, birth, 0)
+        if tuple(sha256(data)) != expect:
+            return False
+        for i in range(tail // 128):
+            bp = BlockPtr(data=bytes(data[i*128:(i+1)*128]))
+            if not bp.empty:
+                self._bptrs.append(bp)
+        self._valid = True
+        return True
+
+    @property
+    def valid(self):
+        return self._valid
+
+    @property
+    def bptrs(self):
+        return self._bptrs
+
+    def __len__(self):
+        return len(self._bptrs)
@@ -28,8 +28,13 @@
 
 
 from zfs.blockptr import BlockPtrArray
+from zfs.cache import LRU
 from zfs.col import color
 
+# Parsed indirect blocks kept per tree. Their data stays in the block cache
+# of the device for longer.
+TREE_CACHE_BLOCKS = 64
+
 class BlockTree:
     VERBOSE_TRAVERSE=False
 
@@ -37,7 +42,7 @@ class BlockTree:
         self._levels = levels
         self._vdev = vdev
         print("[+] Creating block tree from", root_bptr)
-        self._cache = {}
+        self._cache = LRU(TREE_CACHE_BLOCKS)
         if levels == 1:
             self._root = root_bptr
         else:
@@ -71,12 +76,16 @@ class BlockTree:
             return self._root if item == 0 else None
         indices = self._get_level_indices(item)
         bpa = self._root
-        _cache = self._cache
+        path = ()
         for (l, i) in enumerate(indices[:-1]):
-            if not i in _cache:
-                _cache[i] = { 'b' : None, 'n' : {} } # generate a graph
-            if not _cache[i]['b'] is None:
-                next_bpa = _cache[i]['b']
+            if bpa[i].empty:
+                # Everything below a hole is a hole as well
+                return bpa[i]
+            # Indirect blocks are cached by their indices down the tree
+            path += (i,)
+            cached = self._cache.get(path)
+            if cached is not None:
+                next_bpa = cached[0]
             else:
                 b = bpa[i]
                 bpa_data = None
@@ -89,13 +98,13 @@ class BlockTree:
                     next_bpa = BlockPtrArray(bpa_data)
                 else:
                     print("[-] Block tree is broken at", b)
-                _cache[i]['b'] = next_bpa
+                # Broken blocks are remembered as well
+                self._cache.put(path, (next_bpa,))
             bpa = next_bpa
             if BlockTree.VERBOSE_TRAVERSE:
                    self.printidx(indices, l, str(bpa))
             if bpa is None:
                 return None
-            _cache = _cache[i]['n']
         b = bpa[indices[-1]]
         if BlockTree.VERBOSE_TRAVERSE:
                print(("[t-%d] " %(item))+color.GREEN+str(indices)+color.END+" : "+str(b)+" : "+str(bpa))
@@ -0,0 +1,257 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Caches of decoded blocks. BlockCache sits in front of the devices and is
+shared by everything reading through them, LRU keeps the least recently
+used entries within a size limit. BlockStore keeps metadata blocks on disk
+across runs.
+"""
+
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+
+from zfs.checksum import get_checksum
+
+# Default size of the block cache in bytes
+CACHE_SIZE = 256 * 1024 * 1024
+# Share of the cache reserved for metadata, the rest holds file data
+META_SHARE = 0.75
+# Type of the blocks holding file contents, all other types are metadata
+DMU_OT_PLAIN_FILE_CONTENTS = 19
+DMU_OT_ZVOL = 23
+# Blocks written to the BlockStore between commits
+STORE_COMMIT_EVERY = 256
+
+
+def is_metadata(bptr):
+    return bptr._lvl > 0 or bptr._type not in (DMU_OT_PLAIN_FILE_CONTENTS, DMU_OT_ZVOL)
+
+
+class LRU:
+    """
+    A mapping that evicts the least recently used entries once the total
+    cost of the entries exceeds limit.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._entries = OrderedDict()
+        self._used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, cost=1):
+        if cost > self._limit:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._used -= old[1]
+        self._entries[key] = (value, cost)
+        self._used += cost
+        while self._used > self._limit:
+            key, (value, cost) = self._entries.popitem(last=False)
+            self._used -= cost
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._used = 0
+
+    @property
+    def used(self):
+        return self._used
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BlockCache:
+    """
+    Decoded blocks keyed by the location and birth of their first DVA, so
+    that every copy of a block maps to the same entry. Metadata and file
+    data are kept in separate LRUs, streaming file contents through the
+    cache does not push out the metadata.
+    """
+
+    def __init__(self, size=CACHE_SIZE, meta_share=META_SHARE):
+        self._meta = LRU(int(size * meta_share))
+        self._data = LRU(size - self._meta.limit)
+        # Shared by the I/O threads of the pipeline and the pool
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(bptr):
+        if bptr is None or bptr.empty or bptr._embeded:
+            # Nothing to read for these
+            return None
+        dva = bptr.get_dva(0)
+        return dva._vdev, dva.offset, bptr._birth_txg
+
+    def _lru(self, bptr):
+        return self._meta if is_metadata(bptr) else self._data
+
+    def get(self, bptr):
+        """
+        Returns the cached data of bptr or None.
+        """
+        key = self._key(bptr)
+        if key is None:
+            return None
+        with self._lock:
+            return self._lru(bptr).get(key)
+
+    def put(self, bptr, data):
+        """
+        Adds the data of bptr, which must have passed its checksum. The
+        block is kept as it is and handed to every later reader, like
+        zero_block(), so neither the caller nor the readers may modify it.
+        """
+        key = self._key(bptr)
+        if key is None or data is None:
+            return
+        with self._lock:
+            self._lru(bptr).put(key, data, len(data))
+
+    def clear(self):
+        with self._lock:
+            self._meta.clear()
+            self._data.clear()
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses, evictions and bytes used per class.
+        """
+        with self._lock:
+            return {name: {"hits": lru.hits, "misses": lru.misses, "evictions": lru.evictions,
+                           "blocks": len(lru), "used": lru.used, "limit": lru.limit}
+                    for name, lru in (("meta", self._meta), ("data", self._data))}
+
+    def print_stats(self):
+        for name, s in self.stats().items():
+            lookups = s["hits"] + s["misses"]
+            print("[+] Block cache {}: {} hits / {} misses ({:.1f}%), {} evicted, {} blocks, {}/{} MiB".format(
+                name, s["hits"], s["misses"], 100.0 * s["hits"] / lookups if lookups else 0.0,
+                s["evictions"], s["blocks"], s["used"] >> 20, s["limit"] >> 20))
+
+
+class BlockStore:
+    """
+    Physical metadata blocks kept in an SQLite file, so that a rescue run
+    again after a crash or with other datasets selected does not have to
+    read the MOS and the indirect blocks from the disks again. Entries are
+    keyed by DVA[0], birth and checksum, and are verified against the
+    checksum of the block pointer before they are used.
+    """
+
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS blocks (key BLOB PRIMARY KEY, data BLOB)")
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.invalid = 0
+
+    @staticmethod
+    def _key(bptr):
+        if bptr is None or bptr.empty or bptr._embeded or not is_metadata(bptr):
+            return None
+        if get_checksum(bptr._cksum) is None:
+            # Could not be verified when loaded
+            return None
+        dva = bptr.get_dva(0)
+        return struct.pack("<3Q4Q", dva._vdev, dva.offset, bptr._birth_txg, *bptr._checksum)
+
+    def get(self, bptr):
+        """
+        Returns the physical data of bptr, or None if it is not stored or
+        does not match its checksum.
+        """
+        key = self._key(bptr)
+        if key is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT data FROM blocks WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            data = row[0]
+            if len(data) < bptr.psize or not get_checksum(bptr._cksum).verify(data[0:bptr.psize], bptr._checksum):
+                self._db.execute("DELETE FROM blocks WHERE key=?", (key,))
+                self.invalid += 1
+                return None
+            self.hits += 1
+            return data
+
+    def put(self, bptr, raw):
+        """
+        Stores raw, the physical data of bptr that passed its checksum.
+        """
+        key = self._key(bptr)
+        if key is None or raw is None:
+            return
+        with self._lock:
+            cur = self._db.execute("INSERT OR IGNORE INTO blocks VALUES (?, ?)",
+                                   (key, bytes(raw[0:bptr.psize])))
+            if cur.rowcount > 0:
+                self.stored += 1
+                self._pending += 1
+                if self._pending >= STORE_COMMIT_EVERY:
+                    self._db.commit()
+                    self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def print_stats(self):
+        print("[+] Block store: {} hits / {} misses, {} invalid, {} blocks stored".format(
+            self.hits, self.misses, self.invalid, self.stored))
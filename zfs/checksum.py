@@ -0,0 +1,230 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Block checksums. Implementations are registered by the checksum type stored
+in the block pointer, read_block() looks them up with get_checksum().
+"""
+
+import hashlib
+import struct
+import sys
+import time
+from array import array
+from itertools import accumulate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this size the NumPy call overhead outweighs the vectorization
+NUMPY_MIN_SIZE = 2048
+# Blocks up to this many words are checksummed with a precomputed weight table
+FLETCHER4_TABLE_WORDS = 32768
+MASK64 = 0xffffffffffffffff
+
+CHKSUM_FLETCHER_2 = 6
+CHKSUM_FLETCHER_4 = 7
+CHKSUM_SHA256 = 8
+CHKSUM_SHA512 = 11
+
+
+class Checksum:
+
+    def __init__(self, name, func, zero_sum=False):
+        self.name = name
+        self.func = func
+        # The checksum of an all-zero block is zero
+        self.zero_sum = zero_sum
+
+    def verify(self, data, expected):
+        """
+        Returns whether the checksum of data matches expected, the checksum
+        words of the block pointer.
+        """
+        return tuple(self.func(data)) == tuple(expected)
+
+
+_checksums = {}
+
+def register_checksum(cksum_type, name, func, zero_sum=False):
+    """
+    Registers func as the implementation of cksum_type. func takes the
+    physical block and returns the four 64-bit checksum words.
+    """
+    _checksums[cksum_type] = Checksum(name, func, zero_sum)
+
+def get_checksum(cksum_type):
+    return _checksums.get(cksum_type)
+
+
+def _pad(data, align):
+    e = (align - (len(data) % align)) % align
+    if e > 0:
+        data = bytes(data) + bytes(e)
+    return data
+
+def _words(data, typecode, size):
+    words = array(typecode)
+    if words.itemsize != size:
+        fmt = "<%d%s" % (len(data) // size, 'I' if size == 4 else 'Q')
+        return struct.unpack(fmt, data)
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def fletcher2(data):
+    """
+    Computes the ZFS fletcher2 checksum of data. Uses NumPy if available
+    and falls back to a pure Python implementation otherwise.
+    """
+    data = _pad(data, 16)
+    if numpy is not None and len(data) >= NUMPY_MIN_SIZE:
+        return _fletcher2_numpy(data)
+    return _fletcher2_py(data)
+
+def _fletcher2_py(data):
+    # Two interleaved running sums over 64-bit words, b is the sum of the
+    # intermediate values of a.
+    words = _words(data, 'Q', 8)
+    even = words[0::2]
+    odd = words[1::2]
+    if len(even) == 0:
+        return (0, 0, 0, 0)
+    a0 = sum(even)
+    a1 = sum(odd)
+    b0 = sum(accumulate(even))
+    b1 = sum(accumulate(odd))
+    return (a0&MASK64,a1&MASK64,b0&MASK64,b1&MASK64)
+
+def _fletcher2_numpy(data):
+    # Pair j of m is added m-j times to b
+    words = numpy.frombuffer(data, dtype='<u8').astype(numpy.uint64).reshape(-1, 2)
+    m = len(words)
+    weights = numpy.arange(m, 0, -1, dtype=numpy.uint64)
+    a = words.sum(axis=0, dtype=numpy.uint64)
+    b = weights @ words
+    return (int(a[0]), int(a[1]), int(b[0]), int(b[1]))
+
+
+def fletcher4(data):
+    """
+    Computes the ZFS fletcher4 checksum of data. Uses NumPy if available
+    and falls back to a pure Python implementation otherwise.
+    """
+    data = _pad(data, 4)
+    if numpy is not None and len(data) >= NUMPY_MIN_SIZE:
+        return _fletcher4_numpy(data)
+    return _fletcher4_py(data)
+
+def _fletcher4_py(data):
+    # The running sums are prefix sums of one another: the final b is the
+    # sum of all intermediate values of a, c that of b and d that of c.
+    # accumulate() computes them without a Python-level loop.
+    words = _words(data, 'I', 4)
+    if len(words) == 0:
+        return (0, 0, 0, 0)
+    pb = list(accumulate(accumulate(words)))
+    pc = list(accumulate(pb))
+    a = sum(words)
+    b = pb[-1]
+    c = pc[-1]
+    d = sum(pc)
+    return (a&MASK64,b&MASK64,c&MASK64,d&MASK64)
+
+_fletcher4_weights = None
+
+def _fletcher4_table():
+    # Word i of an n word block adds 1, n-i, (n-i)(n-i+1)/2 and
+    # (n-i)(n-i+1)(n-i+2)/6 times to a, b, c and d. The weights of a
+    # shorter block are the tail of the table.
+    global _fletcher4_weights
+    if _fletcher4_weights is None:
+        w = numpy.ones((4, FLETCHER4_TABLE_WORDS), dtype=numpy.uint64)
+        for i in range(1, 4):
+            numpy.cumsum(w[i-1], dtype=numpy.uint64, out=w[i])
+        _fletcher4_weights = w[:, ::-1].copy()
+    return _fletcher4_weights
+
+def _fletcher4_numpy(data):
+    # uint64 arithmetic wraps like the C code
+    words = numpy.frombuffer(data, dtype='<u4').astype(numpy.uint64)
+    n = len(words)
+    if n <= FLETCHER4_TABLE_WORDS:
+        weights = _fletcher4_table()[:, FLETCHER4_TABLE_WORDS-n:]
+        return tuple(int(v) for v in weights @ words)
+    pa = numpy.cumsum(words, dtype=numpy.uint64)
+    pb = numpy.cumsum(pa, dtype=numpy.uint64)
+    pc = numpy.cumsum(pb, dtype=numpy.uint64)
+    return (int(pa[-1]), int(pb[-1]), int(pc[-1]), int(pc.sum(dtype=numpy.uint64)))
+
+
+def sha256(data):
+    """
+    Computes the SHA-256 checksum of data. ZFS stores the digest as four
+    big-endian 64-bit words.
+    """
+    return struct.unpack('>4Q', hashlib.sha256(data).digest())
+
+def sha512_256(data):
+    return struct.unpack('>4Q', hashlib.new('sha512_256', data).digest())
+
+
+register_checksum(CHKSUM_FLETCHER_2, "fletcher2", fletcher2, zero_sum=True)
+register_checksum(CHKSUM_FLETCHER_4, "fletcher4", fletcher4, zero_sum=True)
+register_checksum(CHKSUM_SHA256, "SHA-256", sha256)
+if 'sha512_256' in hashlib.algorithms_available:
+    register_checksum(CHKSUM_SHA512, "SHA-512", sha512_256)
+
+
+def bench(size=131072, rounds=100):
+    """
+    Returns the throughput of every registered checksum in MB/s.
+    """
+    data = bytes(range(256)) * (size // 256)
+    result = {}
+    for cksum_type in sorted(_checksums):
+        cksum = _checksums[cksum_type]
+        if cksum.name in result:
+            continue
+        start = time.perf_counter()
+        for i in range(rounds):
+            cksum.func(data)
+        elapsed = time.perf_counter() - start
+        result[cksum.name] = (size * rounds) / elapsed / (1 << 20)
+    return result
+
+
+if __name__ == "__main__":
+    print("[+] NumPy {}".format("enabled" if numpy is not None else "not available"))
+    for name, rate in bench().items():
+        print("[+] {:10} {:10.1f} MB/s".format(name, rate))
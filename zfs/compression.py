@@ -0,0 +1,125 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Block decompression. Every codec decodes straight into a buffer of the
+logical block size supplied by the caller.
+"""
+
+import struct
+import zlib
+
+from zfs.lzjb import lzjb_decompress_into
+from zfs.lz4zfs import lz4zfs_decompress_into
+
+COMP_ON = 1
+COMP_OFF = 2
+COMP_LZJB = 3
+COMP_EMPTY = 4
+COMP_GZIP_1 = 5
+COMP_GZIP_9 = 13
+COMP_ZLE = 14
+COMP_LZ4 = 15
+
+# ZFS compresses with ZLE at level 64
+ZLE_LEVEL = 64
+
+
+def decompress_into(alg, src, dst):
+    """
+    Decompresses src, compressed with alg, into the writable buffer dst. The
+    output must fit in dst, bytes past the decoded data are left untouched.
+
+    Returns the number of bytes written, or None if the algorithm is not
+    supported or src is corrupted.
+    """
+    func = _decompressors.get(alg)
+    if func is None:
+        return None
+    try:
+        return func(src, dst)
+    except (ValueError, IndexError, struct.error, zlib.error):
+        return None
+
+
+def _copy_into(src, dst):
+    n = min(len(src), len(dst))
+    dst[0:n] = src[0:n]
+    return n
+
+def _empty_into(src, dst):
+    dst[0:len(dst)] = bytes(len(dst))
+    return len(dst)
+
+def _gzip_into(src, dst):
+    # Bound the output, a corrupted stream must not inflate without limit
+    out = zlib.decompressobj().decompress(src, len(dst))
+    dst[0:len(out)] = out
+    return len(out)
+
+def _zle_into(src, dst, level=ZLE_LEVEL):
+    # Every run starts with a length byte. Up to level it counts literals,
+    # above it zeros.
+    slen = len(src)
+    dlen = len(dst)
+    pos = 0
+    dpos = 0
+    while pos < slen and dpos < dlen:
+        length = src[pos] + 1
+        pos += 1
+        if length <= level:
+            if pos + length > slen or dpos + length > dlen:
+                raise ValueError("ZLE literals past the end")
+            dst[dpos:dpos + length] = src[pos:pos + length]
+            pos += length
+        else:
+            length -= level
+            if dpos + length > dlen:
+                raise ValueError("ZLE zeros past the end")
+            dst[dpos:dpos + length] = bytes(length)
+        dpos += length
+    return dpos
+
+def _lzjb_into(src, dst):
+    n = lzjb_decompress_into(src, dst)
+    if n is None:
+        raise ValueError("corrupted LZJB stream")
+    return n
+
+
+_decompressors = {
+    COMP_ON: _lzjb_into,
+    COMP_OFF: _copy_into,
+    COMP_LZJB: _lzjb_into,
+    COMP_EMPTY: _empty_into,
+    COMP_ZLE: _zle_into,
+    COMP_LZ4: lz4zfs_decompress_into,
+}
+for _alg in range(COMP_GZIP_1, COMP_GZIP_9 + 1):
+    _decompressors[_alg] = _gzip_into
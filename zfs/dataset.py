@@ -32,6 +32,7 @@ from zfs.zap import zap_factory, TYPECODES, safe_decode_string
 from zfs.blocktree import BlockTree
 from zfs.sa import SystemAttr
 from zfs.fileobj import FileObj
+from zfs.zio import zero_block
 from zfs.col import color
 
 import csv
@@ -159,21 +160,27 @@ class Dataset(ObjectSet):
         corrupted = False
         tt = -time.time()
         if file_dnode.bonus.zp_size > 0:
-            for n in range(num_blocks):
-                bp = bt[n]
+            bptrs = (bt[n] for n in range(num_blocks))
+            for n, (bp, (block_data, c)) in enumerate(self._vdev.iter_blocks(bptrs, dva=0)):
                 bad_block = False
                 if bp is None:
                     print("[-]  Broken block tree")
                     bad_block = True
-                else:
-                    block_data,c = self._vdev.read_block(bp, dva=0)
-                    if (not c) or block_data is None:
-                        print("[-]  Unreadable block")
-                        bad_block = True
+                elif bp.empty:
+                    # Hole in a sparse file
+                    block_data = zero_block(file_dnode.datablksize)
+                elif (not c) or block_data is None:
+                    print("[-]  Unreadable block")
+                    bad_block = True
                 if bad_block:
-                    block_data = b'\x00' * file_dnode.datablksize
+                    block_data = zero_block(file_dnode.datablksize)
                     corrupted = True
-                f.write(block_data)
+                if block_data is zero_block(len(block_data)):
+                    # Leave a hole in the output, truncate() below extends
+                    # the file if it ends with one
+                    f.seek(len(block_data), 1)
+                else:
+                    f.write(block_data)
                 total_len += len(block_data)
                 if n % 16 == 0:
                     print("[+]  Block {:>3}/{} total {:>7} bytes".format(n, num_blocks, total_len))
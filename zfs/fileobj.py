@@ -27,7 +27,9 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+from collections import deque
 from zfs.blocktree import BlockTree
+from zfs.zio import zero_block, READ_BATCH
 
 
 class FileObj:
@@ -42,6 +44,7 @@ class FileObj:
         self._filepos = 0
         self._blkpos = 0
         self._buf = bytearray()
+        self._ahead = deque()
         self._corrupted = False
         self._bad_as_zeros = bad_as_zeros
 
@@ -58,16 +61,10 @@ class FileObj:
                 print("[-]  Reading past last file block")
                 bad_block = True
             if not bad_block:
-                bptr = self._bt[self._next_blkid]
-                self._next_blkid += 1
-                if bptr is None:
-                    print("[-]  Broken block tree")
+                self._buf, error = self._next_block()
+                if error is not None:
+                    print("[-]  {}".format(error))
                     bad_block = True
-                else:
-                    self._buf,c = self._vdev.read_block(bptr, dva=0)
-                    if (not c) or self._buf is None:
-                        print("[-]  Unreadable block")
-                        bad_block = True
             if bad_block:
                 self._corrupted = True
                 if self._bad_as_zeros:
@@ -84,6 +81,31 @@ class FileObj:
         self._filepos += l
         return data
 
+    def _next_block(self):
+        # Returns the data of the next block and an error message
+        if not self._ahead:
+            self._read_ahead()
+        self._next_blkid += 1
+        return self._ahead.popleft()
+
+    def _read_ahead(self):
+        last = min(self._next_blkid + READ_BATCH, self._max_blkid + 1)
+        bptrs = [self._bt[i] for i in range(self._next_blkid, last)]
+        reads = [bptr for bptr in bptrs if bptr is not None and not bptr.empty]
+        results = iter(self._vdev.read_blocks(reads, dva=0))
+        for bptr in bptrs:
+            if bptr is None:
+                self._ahead.append((None, "Broken block tree"))
+            elif bptr.empty:
+                # Hole in a sparse file
+                self._ahead.append((zero_block(self._datablksize), None))
+            else:
+                buf,c = next(results)
+                if (not c) or buf is None:
+                    self._ahead.append((None, "Unreadable block"))
+                else:
+                    self._ahead.append((buf, None))
+
     def tell(self):
         return self._filepos
 
@@ -99,10 +99,15 @@ class Label:
         return None
 
     def get_vdev_disks(self):
-        try:
-            return list(map(lambda x: x['path'], self._nvlist['vdev_tree']['children']))
-        except:
-            return list([self._nvlist['vdev_tree']['path']]) # pool of one
+        # Replacing and spare children hold several disks, all with labels
+        def leaves(tree):
+            if 'children' not in tree:
+                return [tree['path']] if 'path' in tree else []
+            return [path for child in tree['children'] for path in leaves(child)]
+        return leaves(self._nvlist['vdev_tree'])
+
+    def get_vdev_tree(self):
+        return self._nvlist['vdev_tree']
 
     def get_txg(self):
         return self._nvlist['txg']
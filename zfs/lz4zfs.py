@@ -1,62 +1,116 @@
+import ctypes
+import ctypes.util
 import struct
 
 RUN_MASK=0xf
 ML_MASK=0xf
 
+# Use the system liblz4 when it can be found
+USE_LIBLZ4 = True
+
+_liblz4 = None
+if USE_LIBLZ4:
+    try:
+        _libname = ctypes.util.find_library("lz4")
+        if _libname is not None:
+            _liblz4 = ctypes.CDLL(_libname)
+            _liblz4.LZ4_decompress_safe.argtypes = [ctypes.c_char_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+            _liblz4.LZ4_decompress_safe.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _liblz4 = None
+
+
 def lz4zfs_decompress(src,dsize):
     """
-    Decompresses src, a bytearray of compressed data.
+    Decompresses src, a bytearray of compressed data. Returns a bytearray of
+    dsize bytes or None if the data is corrupted.
+    """
+    dst = bytearray(dsize)
+    try:
+        lz4zfs_decompress_into(src, dst)
+    except (ValueError, IndexError, struct.error):
+        return None
+    return dst
+
+def lz4zfs_decompress_into(src, dst):
     """
-    VERBOSE=0
+    Decompresses src into the writable buffer dst and returns the number of
+    bytes produced. Bytes of dst past that are left untouched. Raises
+    ValueError if the data is corrupted or does not fit.
+    """
+    clen, = struct.unpack_from(">I", src, 0)
+    iend = 4 + clen
+    if iend > len(src):
+        raise ValueError("LZ4 stream longer than the block")
+    if _liblz4 is not None:
+        return _decompress_lib(src, dst, iend)
+    return _decompress_py(src, dst, iend)
+
+def _decompress_lib(src, dst, iend):
+    csrc = bytes(src[4:iend])
+    cdst = (ctypes.c_char * len(dst)).from_buffer(dst)
+    n = _liblz4.LZ4_decompress_safe(csrc, cdst, len(csrc), len(dst))
+    if n < 0:
+        raise ValueError("corrupted LZ4 stream")
+    return n
+
+def _decompress_py(src, dst, iend):
     ip = 4
-    iend, = struct.unpack(">I",src[0:4]);
-    dst = bytearray()
+    op = 0
+    oend = len(dst)
 
-    try:
-        while (ip < iend):
-            token = src[ip]
-            if VERBOSE:
-                print("[%02d->%02d]: token 0x%x" %(ip-4, len(dst), token));
-
-            ip += 1
-            length = (token >> 4);
-            if (length == RUN_MASK) :
-                s = 255;
-                while ((ip < iend) and (s == 255)) :
-                    s = src[ip]
-                    length += s
-                    ip += 1
-
-            if VERBOSE:
-                print(" + copy length 0x%x" %(length));
-
-            dst += src[ip:ip+length]
-            ip += length
+    while (ip < iend):
+        token = src[ip]
+        ip += 1
 
-            off, = struct.unpack("<H",src[ip:ip+2]);
-            ip += 2
-            ref = len(dst) - off;
+        length = (token >> 4)
+        if (length == RUN_MASK):
+            s = 255
+            while ((ip < iend) and (s == 255)):
+                s = src[ip]
+                length += s
+                ip += 1
 
-            length = (token & ML_MASK);
-            if (length == ML_MASK):
-                while (ip < iend) :
-                    s = src[ip]
-                    ip += 1
-                    length += s;
-                    if (s == 255):
-                        continue;
-                    break;
+        if length:
+            if (op + length > oend) or (ip + length > iend):
+                raise ValueError("literals past the end of the buffer")
+            dst[op:op+length] = src[ip:ip+length]
+            op += length
+            ip += length
 
-            if VERBOSE:
-                print(" + copy rep-length %d from -%d" %(length, off));
+        # The last sequence has literals only
+        if (ip >= iend):
+            break
 
-            length += 4
+        off = src[ip] | (src[ip+1] << 8)
+        ip += 2
+        if (off == 0) or (off > op):
+            raise ValueError("match offset outside the output")
 
-            # use sliding window
-            for i in range(length):
-                dst += dst[len(dst)-off:len(dst)-off+1]
+        length = (token & ML_MASK)
+        if (length == ML_MASK):
+            while (ip < iend):
+                s = src[ip]
+                ip += 1
+                length += s
+                if (s != 255):
+                    break
+        length += 4
 
-    except Exception as e:
-        dst = None
+        end = op + length
+        if (end > oend):
+            raise ValueError("match past the end of the buffer")
+        ref = op - off
+        if (length <= off):
+            dst[op:end] = dst[ref:end-off]
+            op = end
+        else:
+            # The match overlaps its own output and repeats the last off
+            # bytes. Everything from ref on has that period, so the window
+            # that can be copied at once doubles with every step.
+            while (op < end):
+                n = min(op - ref, end - op)
+                dst[op:op+n] = dst[ref:ref+n]
+                op += n
 
-    return dst
+    return op
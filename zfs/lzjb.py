@@ -34,6 +34,8 @@ MATCH_MAX = (1 << MATCH_BITS) + (MATCH_MIN - 1)
 MATCH_RANGE = range(MATCH_MIN, MATCH_MAX + 1)     # Length 64, fine on 2.x.
 OFFSET_MASK = (1 << (16 - MATCH_BITS)) - 1
 LEMPEL_SIZE = 1024
+# Number of literals before the next match for each copymap value
+_LITERAL_RUN = [BYTE_BITS] + [(v & -v).bit_length() - 1 for v in range(1, 1 << BYTE_BITS)]
 
 
 def size_encode(size, dst=None):
@@ -130,38 +132,63 @@ def lzjb_decompress(src, dlen, dst=None):
     """
     Decompresses src, a bytearray of compressed data.
 
-    The dst argument can be an optional bytearray which will have the output appended.
-    If it's None, a new bytearray is created.
+    The dst argument can be an optional writable buffer of at least dlen bytes
+    to decompress into. If it's None, a new bytearray of dlen bytes is created.
 
-    The output bytearray is returned.
+    The output buffer is returned, or None if src is corrupted.
     """
 
     if dst is None:
-        dst = bytearray()
+        dst = bytearray(dlen)
+    if lzjb_decompress_into(src, dst, dlen) is None:
+        return None
+    return dst
+
+
+def lzjb_decompress_into(src, dst, dlen=None):
+    """
+    Decompresses src into the start of dst, stopping after dlen bytes (the
+    length of dst by default).
+
+    Returns the number of bytes written, or None if src is corrupted.
+    """
+
+    if dlen is None:
+        dlen = len(dst)
+    slen = len(src)
     pos = 0
     dpos = 0
-    copymap = 0
-    copymask = 1 << (BYTE_BITS - 1)
-    while pos < len(src):
-        copymask <<= 1
-        if copymask == (1 << BYTE_BITS):
-            copymask = 1
-            copymap = src[pos]
-            pos += 1
-        if copymap & copymask:
-            mlen = (src[pos] >> (BYTE_BITS - MATCH_BITS)) + MATCH_MIN
-            offset = ((src[pos] << BYTE_BITS) | src[pos + 1]) & OFFSET_MASK
-            pos += 2
-            cpy = dpos - offset
-            if cpy < 0:
-                return None
-            while mlen > 0 and dpos < dlen:
-                dst.append(dst[cpy])
-                dpos += 1
-                cpy += 1
-                mlen -= 1
-        elif dpos < dlen:
-            dst.append(src[pos])
-            dpos += 1
-            pos += 1
-    return dst
+    while pos < slen and dpos < dlen:
+        copymap = src[pos]
+        pos += 1
+        bit = 0
+        while bit < BYTE_BITS and pos < slen and dpos < dlen:
+            if (copymap >> bit) & 1:
+                if pos + 1 >= slen:
+                    return None
+                mlen = (src[pos] >> (BYTE_BITS - MATCH_BITS)) + MATCH_MIN
+                offset = ((src[pos] << BYTE_BITS) | src[pos + 1]) & OFFSET_MASK
+                pos += 2
+                cpy = dpos - offset
+                if cpy < 0 or offset == 0:
+                    return None
+                end = min(dpos + mlen, dlen)
+                if offset >= end - dpos:
+                    dst[dpos:end] = dst[cpy:cpy + end - dpos]
+                    dpos = end
+                else:
+                    # Overlapping match, the window doubles with every copy
+                    while dpos < end:
+                        n = min(dpos - cpy, end - dpos)
+                        dst[dpos:dpos + n] = dst[cpy:cpy + n]
+                        dpos += n
+                bit += 1
+            else:
+                # Copy the run of literals up to the next match at once
+                run = min(_LITERAL_RUN[copymap >> bit], BYTE_BITS - bit)
+                n = min(run, slen - pos, dlen - dpos)
+                dst[dpos:dpos + n] = src[pos:pos + n]
+                pos += n
+                dpos += n
+                bit += run
+    return dpos
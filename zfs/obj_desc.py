@@ -103,6 +103,7 @@ COMP_DESC = [
     "lz4"
 ]
 
-CHKSUM_DESC = ["invalid", "fletcher2", "none", "SHA-256", "SHA-256", "fletcher2", "fletcher2", "fletcher4", "SHA-256"]
+CHKSUM_DESC = ["invalid", "fletcher2", "none", "SHA-256", "SHA-256", "fletcher2", "fletcher2", "fletcher4", "SHA-256", "fletcher4",
+               "noparity", "SHA-512", "skein", "edonr"]
 
 ENDIAN_DESC = ["BE", "LE"]
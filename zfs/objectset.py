@@ -29,12 +29,19 @@
 
 from zfs.dnode import DNode
 from zfs.blocktree import BlockTree
+from zfs.cache import LRU
+
+# Dnode blocks kept per object set, unreadable ones included so that the
+# dnodes of a damaged block do not read and recover it again one by one.
+# The data of good blocks stays in the block cache of the device for longer.
+OBJSET_CACHE_BLOCKS = 16
 
 
 class ObjectSet:
 
     def __init__(self, vdev, os_bptr, dvas=(0,1)):
         self._vdev = vdev
+        self._cache = LRU(OBJSET_CACHE_BLOCKS)
         # Load the object set dnode
         self._dnode = self._load_os_dnode(os_bptr, dvas)
         if self._dnode is None:
@@ -57,7 +64,6 @@ class ObjectSet:
             return
         # print("[+] Block pointer 0 is", self._blocktree[0])
         # print("[+] Block pointer {} is {}".format(self._dnode.maxblkid, self._blocktree[self._dnode.maxblkid]))
-        self._block_cache = {}
         self._broken = False
 
     def prefetch(self):
@@ -89,8 +95,9 @@ class ObjectSet:
             print("[-] Accessing a broken object set!")
             return None
         blockid = dnode_id // self._dnodes_per_block
-        if blockid in self._block_cache:
-            block_data = self._block_cache[blockid]
+        cached = self._cache.get(blockid)
+        if cached is not None:
+            block_data = cached[0]
         else:
             block_data = None
             bp = self._blocktree[blockid]
@@ -99,7 +106,8 @@ class ObjectSet:
                     block_data,c = self._vdev.read_block(bp, dva=dva)
                     if block_data and c:
                         break
-            self._block_cache[blockid] = block_data
+            # Broken blocks are remembered as well
+            self._cache.put(blockid, (block_data,))
         if block_data is None:
             return None
         dnid = dnode_id % self._dnodes_per_block
@@ -0,0 +1,140 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from zfs.zio import decode_block, READ_BATCH
+
+# Threads issuing the physical reads
+IO_THREADS = 2
+# Batches in flight in each stage
+PIPELINE_DEPTH = 4
+
+
+class BlockPipeline:
+    """
+    Reads blocks in two overlapping stages. I/O threads fetch the physical
+    data of batches of blocks ahead of time, while a pool of processes
+    verifies and decompresses the batches already read. Results come out
+    in the order of the block pointers.
+    """
+
+    def __init__(self, vdev, io_threads=IO_THREADS, workers=None,
+                 depth=PIPELINE_DEPTH, batch=READ_BATCH):
+        self._vdev = vdev
+        self._depth = depth
+        self._batch = batch
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._io = ThreadPoolExecutor(max_workers=io_threads)
+        # Without worker processes the I/O threads decode as well. zlib,
+        # hashlib, liblz4 and NumPy release the GIL, the Python codecs do not.
+        self._cpu = None
+        if workers > 0:
+            self._cpu = ProcessPoolExecutor(max_workers=workers, mp_context=_worker_context())
+
+    def iter_blocks(self, bptrs, dva=0):
+        """
+        Yields (bptr, (data, cksum)) for every block pointer of the iterable
+        bptrs, in order.
+        """
+        batches = self._batches(bptrs)
+        io_pending = deque()
+        cpu_pending = deque()
+
+        def submit_io():
+            batch = next(batches, None)
+            if batch is not None:
+                io_pending.append((batch, self._io.submit(self._vdev.read_physical_blocks, batch, dva)))
+
+        for i in range(self._depth):
+            submit_io()
+        while io_pending or cpu_pending:
+            while io_pending and len(cpu_pending) < self._depth:
+                batch, future = io_pending.popleft()
+                raws = future.result()
+                submit_io()
+                cpu_pending.append((batch, raws, [self._submit_decode(bptr, raw, result)
+                                                  for bptr, (raw, result) in zip(batch, raws)]))
+            batch, raws, results = cpu_pending.popleft()
+            for bptr, (raw, _), result in zip(batch, raws, results):
+                if isinstance(result, Future):
+                    result = result.result()
+                    if not result[1]:
+                        raw = None
+                        result = self._vdev.recover_block(bptr, dva) or result
+                    self._vdev.cache_block(bptr, result, raw)
+                yield bptr, result
+
+    def close(self):
+        self._io.shutdown()
+        if self._cpu is not None:
+            self._cpu.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _batches(self, bptrs):
+        batch = []
+        for bptr in bptrs:
+            batch.append(bptr)
+            if len(batch) == self._batch:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _submit_decode(self, bptr, raw, result):
+        if result is not None:
+            return result
+        verbose = self._vdev._verbose
+        if self._cpu is None:
+            return self._io.submit(decode_block, bptr, raw, verbose)
+        # Views of the proxy buffers cannot be sent to another process
+        if isinstance(raw, memoryview):
+            raw = raw.tobytes()
+        return self._cpu.submit(decode_block, bptr, raw, verbose)
+
+
+def _worker_context():
+    # The workers start while the I/O threads are running. Forking then
+    # could copy a lock held by another thread into the child, so they are
+    # forked from a clean server process instead. It only preloads the
+    # decoder, not the main script.
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["zfs.zio"])
+    return ctx
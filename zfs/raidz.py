@@ -0,0 +1,146 @@
+# Copyright (c) 2017 Hristo Iliev <github@hiliev.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Raidz parity arithmetic. P is the XOR of the data columns, Q and R are
+sums over GF(2^8) with the data columns multiplied by powers of 2 and 4.
+Columns are multiplied by a constant with bytes.translate() and added
+(XORed) as big integers, so no Python loop runs over the bytes.
+"""
+
+# Generator polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_POLY = 0x11d
+# Generators of the P, Q and R parity columns
+PARITY_GEN = (1, 2, 4)
+
+_gf_exp = [0] * 512
+_gf_log = [0] * 256
+_x = 1
+for _i in range(255):
+    _gf_exp[_i] = _x
+    _gf_log[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= GF_POLY
+for _i in range(255, 512):
+    _gf_exp[_i] = _gf_exp[_i - 255]
+
+_mul_tables = {}
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return _gf_exp[_gf_log[a] + _gf_log[b]]
+
+def gf_inv(a):
+    return _gf_exp[255 - _gf_log[a]]
+
+def gf_pow(a, n):
+    if n == 0:
+        return 1
+    return _gf_exp[(_gf_log[a] * n) % 255]
+
+def mul_table(c):
+    """
+    Returns the bytes.translate() table multiplying by c.
+    """
+    table = _mul_tables.get(c)
+    if table is None:
+        table = _mul_tables.setdefault(c, bytes(gf_mul(c, v) for v in range(256)))
+    return table
+
+def gf_mul_column(c, data):
+    if c == 1:
+        return data
+    return bytes(data).translate(mul_table(c))
+
+def xor_into(dst, *cols):
+    """
+    XORs the columns into the start of the writable buffer dst. Columns
+    shorter than dst act as if padded with zeros.
+    """
+    acc = int.from_bytes(dst, 'little')
+    for d in cols:
+        acc ^= int.from_bytes(d, 'little')
+    dst[0:len(dst)] = acc.to_bytes(len(dst), 'little')
+
+def parity_coef(p, i, ndata):
+    # Q and R are computed by Horner's rule over the data columns, so the
+    # first column carries the highest power of the generator
+    return gf_pow(PARITY_GEN[p], ndata - 1 - i)
+
+def _invert(matrix):
+    # Gauss-Jordan elimination over GF(2^8)
+    n = len(matrix)
+    a = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if a[r][col]), None)
+        if pivot is None:
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+        inv = gf_inv(a[col][col])
+        a[col] = [gf_mul(inv, v) for v in a[col]]
+        for r in range(n):
+            if r != col and a[r][col]:
+                f = a[r][col]
+                a[r] = [v ^ gf_mul(f, w) for v, w in zip(a[r], a[col])]
+    return [row[n:] for row in a]
+
+def reconstruct(col_data, nparity, missing):
+    """
+    Rebuilds the data columns listed in missing. col_data holds the parity
+    columns followed by the data columns, missing the indices of columns
+    that cannot be trusted, parity columns included. Returns a new list of
+    columns or None if there is not enough parity left.
+    """
+    ndata = len(col_data) - nparity
+    bad = [c for c in missing if c >= nparity]
+    if not bad:
+        return list(col_data)
+    rows = [p for p in range(nparity) if p not in missing][:len(bad)]
+    if len(rows) < len(bad):
+        return None
+    size = len(col_data[0])
+    # Syndromes: the parity with the contribution of the good columns removed
+    syndromes = []
+    for p in rows:
+        s = bytearray(col_data[p])
+        xor_into(s, *[gf_mul_column(parity_coef(p, c - nparity, ndata), col_data[c])
+                      for c in range(nparity, len(col_data)) if c not in bad])
+        syndromes.append(bytes(s))
+    inv = _invert([[parity_coef(p, c - nparity, ndata) for c in bad] for p in rows])
+    if inv is None:
+        return None
+    result = list(col_data)
+    for m, c in enumerate(bad):
+        rebuilt = bytearray(size)
+        xor_into(rebuilt, *[gf_mul_column(inv[m][j], syndromes[j]) for j in range(len(rows)) if inv[m][j]])
+        result[c] = rebuilt[0:len(col_data[c])]
+    return result
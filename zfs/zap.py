@@ -238,8 +238,7 @@ def _choose_zap_factory(data, dbsize):
 
 def _blockptrar_zap_factory(vdev, bpa, dbsize, nblocks):
     data = bytearray()
-    for i in range(nblocks):
-        d,c = vdev.read_block(bpa[i])
+    for d,c in vdev.read_blocks([bpa[i] for i in range(nblocks)]):
         if c and not (d is None):
             data += d
     return _choose_zap_factory(data, dbsize)
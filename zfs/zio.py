@@ -27,28 +27,132 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-from zfs.blockptr import fletcher4
+from zfs.checksum import get_checksum
+from zfs.blockptr import GangHeader, GANG_HEADER_SIZE
 from block_proxy.proxy import BlockProxy
-from zfs.lzjb import lzjb_decompress
-from zfs.lz4zfs import lz4zfs_decompress
+from zfs.compression import decompress_into
+from zfs import raidz
 
 from os import path
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import struct;
-import zlib
 
 LOG_QUIET = 0
 LOG_VERBOSE = 1
 LOG_NOISY = 5
 
 DO_CHKSUM = 1
+# read_blocks() merges reads on the same disk that are at most this far
+# apart, up to this size
+COALESCE_GAP = 64 * 1024
+COALESCE_MAX = 1024 * 1024
+# Number of blocks read at once by the file readers
+READ_BATCH = 32
+# Mirror reads rotate over the children in regions of this size
+MIRROR_SHIFT = 21
+# Raidz column layouts kept per device
+MAP_CACHE_SIZE = 4096
+# Label flags of disks that cannot be relied on
+UNHEALTHY_FLAGS = ('faulted', 'removed', 'offline', 'not_present')
 
 def roundup(x, y):
     return ((x + y - 1) // y) * y
 
 
+_ZERO_PREFIX = bytes(64)
+_zero_blocks = {}
+
+def is_zero(data):
+    # Look at the head first, real blocks almost never start with 64 zeros
+    if bytes(data[0:64]) != _ZERO_PREFIX[:len(data)]:
+        return False
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return data == zero_block(len(data))
+
+def zero_block(size):
+    """
+    Returns a shared immutable block of zeros
+    """
+    block = _zero_blocks.get(size)
+    if block is None:
+        block = _zero_blocks.setdefault(size, bytes(size))
+    return block
+
+
+def decode_block(bptr, data, verbose=LOG_QUIET):
+    """
+    Verifies and decompresses data, the physical block of bptr. Works
+    without a device, so that it can run in worker processes.
+    Returns (data, cksum).
+    """
+    cksum=True
+    psize = bptr.psize
+    lsize = bptr.lsize
+    if (bptr._embeded):
+        data = bptr._embeded_data
+    else:
+        alg = get_checksum(bptr._cksum) if DO_CHKSUM and data is not None else None
+        if alg is not None and alg.zero_sum and is_zero(data[0:psize]):
+            # Unwritten or wiped space. The fletcher checksum of zeros is
+            # zero, so there is nothing to compute or to decompress.
+            if verbose >= LOG_VERBOSE:
+                print("[+]  All-zero block")
+            return zero_block(lsize), not any(bptr._checksum)
+
+        if alg is not None and not alg.verify(data[0:psize], bptr._checksum):
+            print("expect:%016x:%016x:%016x:%016x" %tuple(bptr._checksum))
+            print("got   :%016x:%016x:%016x:%016x" %tuple(alg.func(data[0:psize])))
+            cksum=False
+        elif DO_CHKSUM and verbose >= LOG_VERBOSE:
+            print("[-]  Checksum type {} not verified".format(bptr._cksum))
+    if data is None:
+        return None,cksum
+
+    if bptr.compressed:
+        if bptr.comp_alg in GenericDevice.CompType:
+            if verbose >= LOG_VERBOSE:
+                print("[+]  Decompressing with {}".format(GenericDevice.CompType[bptr.comp_alg]))
+            # Decode straight into a block of the final size. The output
+            # is handed to the caller and may be kept by it, so it is
+            # allocated per block rather than taken from a pool.
+            out = bytearray(lsize)
+            if decompress_into(bptr.comp_alg, data, out) is None:
+                if verbose >= LOG_VERBOSE:
+                    print("[-]   Decompression failed")
+                return None,cksum
+            data = out
+        else:
+            if verbose >= LOG_VERBOSE:
+                print("[-]  Unsupported compression algorithm")
+            return None,cksum
+    if len(data) < lsize:
+        data = bytearray(data)
+        data += b'\0' * (lsize - len(data))
+    elif len(data) > lsize:
+        data = data[0:lsize]
+    if isinstance(data, memoryview):
+        # Do not hand out views of the block proxy buffers
+        data = bytes(data)
+    return data,cksum
+
+def verify_physical(bptr, data):
+    """
+    Checks the physical block data against the checksum of bptr. Returns
+    None if the checksum type is not supported.
+    """
+    alg = get_checksum(bptr._cksum)
+    if alg is None or data is None:
+        return None
+    return alg.verify(data[0:bptr.psize], bptr._checksum)
+
+
 class GenericDevice:
     COMP_TYPE_ON = 1
     COMP_TYPE_LZJB = 3
+    COMP_TYPE_EMPTY = 4
+    COMP_TYPE_ZLE = 14
     COMP_TYPE_LZ4 = 15
     COMP_TYPE_GZIP_1 = 5
     COMP_TYPE_GZIP_2 = 6
@@ -71,184 +175,512 @@ class GenericDevice:
         COMP_TYPE_GZIP_7: "GZIP7",
         COMP_TYPE_GZIP_8: "GZIP8",
         COMP_TYPE_GZIP_9: "GZIP9",
+        COMP_TYPE_ZLE:  "ZLE",
         COMP_TYPE_LZ4:  "LZ4"
     }
-    def __init__(self, child_devs, block_provider_addr, dump_dir="/tmp"):
+    def __init__(self, child_devs, block_provider_addr, dump_dir="/tmp", compression=None):
         self._devs = child_devs
-        self._bp = BlockProxy(block_provider_addr)
+        # compression is the codec asked from block servers for the transfers
+        self._bp = BlockProxy(block_provider_addr, compression=compression)
         self._dump_dir = dump_dir
         self._verbose = LOG_QUIET
+        self._pipeline = None
+        self._cache = None
+        self._store = None
+        # The device that reads the members of gang blocks, which can be
+        # stored on any top-level vdev of the pool
+        self._root = self
 
     def set_verbosity_level(self, level):
         self._verbose = level
 
     def read_block(self, bptr, dva=0, debug_dump=False, debug_prefix="block"):
-        cksum=True
-        if bptr.empty:
-            return None,False
+        done, result = self._check_block(bptr, dva)
+        if done:
+            return result
+        found = self._lookup(bptr)
+        if found is None and not bptr._embeded:
+            found = (self._read_physical(result[0], result[1], debug_dump, debug_prefix), None)
+            if bptr.get_dva(dva).gang:
+                found = self._read_gangs([bptr], [found], dva)[0]
+        if found is not None and found[1] is not None:
+            return found[1]
+        data = None
+        if found is not None:
+            data = found[0]
+        result = self._decode_block(bptr, data, debug_dump, debug_prefix)
+        if not result[1] and not bptr._embeded:
+            # Keep the bad data out of the store
+            data = None
+            result = self.recover_block(bptr, dva) or result
+        self.cache_block(bptr, result, data)
+        return result
+
+    def read_blocks(self, bptrs, dva=0):
+        """
+        Reads several blocks at once. The physical reads of all blocks are
+        sorted per disk and neighbouring ones are merged into larger reads,
+        all of which go to the block server in a single request.
+        Returns a list of (data, cksum) tuples in the order of bptrs.
+        """
+        results = []
+        for bptr, (raw, result) in zip(bptrs, self.read_physical_blocks(bptrs, dva)):
+            if result is None:
+                result = self._decode_block(bptr, raw)
+                if not result[1]:
+                    raw = None
+                    result = self.recover_block(bptr, dva) or result
+                self.cache_block(bptr, result, raw)
+            results.append(result)
+        return results
+
+    def read_physical_blocks(self, bptrs, dva=0):
+        """
+        The I/O half of read_blocks(). Returns a (raw, result) tuple per block,
+        raw is the physical data to pass to decode_block() and result the
+        final (data, cksum) of blocks that need no decoding.
+        """
+        if self._cache is None and self._store is None:
+            return self._read_gangs(bptrs, self._read_physical_batch(bptrs, dva), dva)
+        results = [None] * len(bptrs)
+        missing = []
+        for i, bptr in enumerate(bptrs):
+            results[i] = self._lookup(bptr)
+            if results[i] is None:
+                missing.append(i)
+        if missing:
+            batch = [bptrs[i] for i in missing]
+            for i, result in zip(missing, self._read_gangs(batch, self._read_physical_batch(batch, dva), dva)):
+                results[i] = result
+        return results
+
+    def _read_physical_batch(self, bptrs, dva):
+        # Reads the physical blocks of bptrs, only the headers of gang blocks
+        results = [None] * len(bptrs)
+        plans = []
+        for i, bptr in enumerate(bptrs):
+            if bptr is None:
+                results[i] = (None, (None, False))
+                continue
+            done, result = self._check_block(bptr, dva)
+            if done:
+                results[i] = (None, result)
+            elif bptr._embeded:
+                results[i] = (None, self._decode_block(bptr, None))
+            else:
+                plan = self._map_physical(result[0], result[1])
+                if plan is None:
+                    results[i] = (None, (None, True))
+                else:
+                    plans.append((i, plan))
+        segments = [seg for i, plan in plans for seg in plan[0]]
+        pieces = self._readv_coalesced(segments)
+        n = 0
+        for i, plan in plans:
+            col_data = pieces[n:n+len(plan[0])]
+            n += len(plan[0])
+            results[i] = (self._assemble_physical(plan, col_data, False, None), None)
+        return results
+
+    def iter_blocks(self, bptrs, dva=0):
+        """
+        Reads the blocks of the iterable bptrs in batches and yields
+        (bptr, (data, cksum)) in order. Goes through the pipeline if one is
+        set.
+        """
+        if self._pipeline is not None:
+            yield from self._pipeline.iter_blocks(bptrs, dva)
+            return
+        batch = []
+        for bptr in bptrs:
+            batch.append(bptr)
+            if len(batch) == READ_BATCH:
+                yield from zip(batch, self.read_blocks(batch, dva))
+                batch = []
+        if batch:
+            yield from zip(batch, self.read_blocks(batch, dva))
+
+    def set_pipeline(self, pipeline):
+        self._pipeline = pipeline
+
+    def set_cache(self, cache):
+        """
+        Keeps the blocks read in cache, a zfs.cache.BlockCache, and reads
+        them from there while they stay in it.
+        """
+        self._cache = cache
+
+    def set_store(self, store):
+        """
+        Keeps the physical metadata blocks read in store, a
+        zfs.cache.BlockStore, which outlives the process.
+        """
+        self._store = store
+
+    def _lookup(self, bptr):
+        # Returns (None, result) for blocks found in the cache, (raw, None)
+        # for blocks found in the store and None for the others
+        if self._cache is not None:
+            data = self._cache.get(bptr)
+            if data is not None:
+                return None, (data, True)
+        if self._store is not None:
+            raw = self._store.get(bptr)
+            if raw is not None:
+                return raw, None
+        return None
+
+    def cache_block(self, bptr, result, raw=None):
+        """
+        Adds the (data, cksum) result of reading bptr to the cache, and raw,
+        the physical data it was decoded from, to the store. Results that
+        failed their checksum are ignored.
+        """
+        if not result[1] or bptr._embeded:
+            return
+        if self._cache is not None:
+            self._cache.put(bptr, result[0])
+        if self._store is not None and raw is not None:
+            self._store.put(bptr, raw)
+
+    def recover_block(self, bptr, dva=0):
+        """
+        Called when a block failed its checksum. Devices with redundancy try
+        to rebuild it and return (data, cksum), or None if they cannot.
+        """
         if bptr.get_dva(dva).gang:
-            # TODO: Implement gang blocks
-            raise NotImplementedError("Gang blocks are still not supported")
+            return self._recover_gang(bptr, dva)
+        done, result = self._check_block(bptr, dva)
+        if done or bptr._embeded:
+            return None
+        data = self._recover_physical(result[0], result[1], lambda data: verify_physical(bptr, data))
+        if data is None:
+            return None
+        return self._decode_block(bptr, data)
+
+    def _recover_physical(self, offset, rsize, verify):
+        # Devices with redundancy return the physical data of the block at
+        # offset for which verify() is true, or None
+        return None
+
+    def _read_gang_header(self, bptr, dva, raw):
+        header = GangHeader(raw, bptr)
+        if not header.valid:
+            done, result = self._check_block(bptr, dva)
+            raw = self._recover_physical(result[0], result[1], lambda data: GangHeader(data, bptr).valid)
+            if raw is not None:
+                header = GangHeader(raw, bptr)
+        return header
+
+    def _read_gangs(self, bptrs, results, dva):
+        # Replaces the gang headers in results, as returned by
+        # _read_physical_batch(), with the physical data of the gang blocks,
+        # or with their final result if they had to be recovered or failed.
+        # The members of all gang blocks are read in a single batch.
+        gangs = []
+        members = []
+        for i, bptr in enumerate(bptrs):
+            raw = results[i][0]
+            if raw is None or not bptr.get_dva(dva).gang:
+                continue
+            header = self._read_gang_header(bptr, dva, raw)
+            if not header.valid:
+                print("[-] Bad gang block header at {}".format(hex(bptr.get_dva(dva).offset)[2:]))
+                results[i] = (None, (None, False))
+                continue
+            gangs.append((i, len(members), len(header)))
+            members.extend(header.bptrs)
+        if not gangs:
+            return results
+        if self._verbose >= LOG_VERBOSE:
+            print("[+] Reading {} members of {} gang blocks".format(len(members), len(gangs)))
+        parts = self._root.read_physical_blocks(members, dva)
+        for i, first, n in gangs:
+            pieces = [raw if raw is not None else result[0] for raw, result in parts[first:first+n]]
+            data = self._join_gang(bptrs[i], members[first:first+n], pieces)
+            if data is not None:
+                results[i] = (data, None)
+                continue
+            # A member could not be read, repair them one at a time
+            result = self._root.recover_block(bptrs[i], dva) or (None, False)
+            self.cache_block(bptrs[i], result)
+            results[i] = (None, result)
+        return results
+
+    @staticmethod
+    def _join_gang(bptr, members, pieces):
+        # Gang members are never compressed, their physical data is
+        # concatenated up to the physical size of the gang block
+        data = bytearray(bptr.psize)
+        pos = 0
+        for member, piece in zip(members, pieces):
+            if piece is None:
+                return None
+            n = min(member.psize, bptr.psize - pos)
+            data[pos:pos+n] = piece[0:n]
+            pos += n
+        return data
+
+    def _recover_gang(self, bptr, dva):
+        # Reads the members one at a time so that each of them can be
+        # checked and repaired on its own
+        done, result = self._check_block(bptr, dva)
+        if done:
+            return None
+        raw = self._read_physical(result[0], result[1], False, None)
+        if raw is None:
+            return None
+        header = self._read_gang_header(bptr, dva, raw)
+        if not header.valid:
+            return None
+        pieces = []
+        for member, (data, cksum) in zip(header.bptrs, self._root.read_blocks(header.bptrs, dva)):
+            if not cksum:
+                return None
+            pieces.append(data)
+        data = self._join_gang(bptr, header.bptrs, pieces)
+        if data is None:
+            return None
+        return self._decode_block(bptr, data)
+
+    def _check_block(self, bptr, dva):
+        # Returns (True, result) for blocks that need no physical read and
+        # (False, (offset, rsize)) otherwise
+        if bptr.comp_alg == GenericDevice.COMP_TYPE_EMPTY and not bptr._embeded:
+            # All-zero block, there is nothing stored on disk
+            return True, (zero_block(bptr.lsize), True)
+        if bptr.empty:
+            return True, (None, False)
         offset = bptr.get_dva(dva).offset
         asize = bptr.get_dva(dva)._asize
         psize = bptr.psize
         if offset == 0 and psize == 0:
-            return None,cksum
-        lsize = bptr.lsize
+            return True, (None, True)
         if self._verbose >= LOG_VERBOSE:
             print("[+] Reading block at {}:{}".format(hex(offset)[2:], hex(asize)[2:]))
-        if (bptr._embeded):
-            lsize = bptr._embeded_lsize
-            data = bptr._embeded_data
-        else:
-            rsize = psize
-            if psize < (1 << self._ashift):
-                rsize = 1 << self._ashift
-            data = self._read_physical(offset, rsize, debug_dump, debug_prefix)
-
-            if bptr._cksum == 7 and DO_CHKSUM:
-                a,b,c,d = fletcher4(data[0:psize])
-                if not (a == bptr._checksum[0] and b == bptr._checksum[1] and c == bptr._checksum[2] and d == bptr._checksum[3]):
-                    print("expect:%016x:%016x:%016x:%016x" %(bptr._checksum[0],bptr._checksum[1],bptr._checksum[2],bptr._checksum[3]))
-                    print("got   :%016x:%016x:%016x:%016x" %(a,b,c,d))
-                    cksum=False
-
-        if bptr.compressed:
-            if bptr.comp_alg in GenericDevice.CompType:
-                if self._verbose >= LOG_VERBOSE:
-                    print("[+]  Decompressing with %s", GenericDevice.CompType[bptr.comp_alg])
-                try:
-                    if (bptr.comp_alg == GenericDevice.COMP_TYPE_LZ4):
-                        data = lz4zfs_decompress(data, lsize)
-                    elif (bptr.comp_alg >= GenericDevice.COMP_TYPE_GZIP_1) and \
-                         (bptr.comp_alg <= GenericDevice.COMP_TYPE_GZIP_9) :
-                        data = zlib.decompress(data)
-                    else:
-                        data = lzjb_decompress(data, lsize)
-                except:
-                    data = None
-                if data is None:
-                    if self._verbose >= LOG_VERBOSE:
-                        print("[-]   Decompression failed")
-                    return None,cksum
-            else:
-                if self._verbose >= LOG_VERBOSE:
-                    print("[-]  Unsupported compression algorithm")
-                return None,cksum
-                # data = lz4.frame.decompress(data)
-        if debug_dump:
+        if bptr.get_dva(dva).gang:
+            # Only the gang header is stored at the DVA
+            psize = GANG_HEADER_SIZE
+        rsize = psize
+        if psize < (1 << self._ashift):
+            rsize = 1 << self._ashift
+        return False, (offset, rsize)
+
+    def _decode_block(self, bptr, data, debug_dump=False, debug_prefix="block"):
+        data,cksum = decode_block(bptr, data, self._verbose)
+        if debug_dump and data is not None:
             f = open(path.join(self._dump_dir, "{}.raw".format(debug_prefix)), "wb")
             f.write(data)
             f.close()
-        if len(data) < lsize:
-            data += b'\0' * (lsize - len(data))
-        elif len(data) > lsize:
-            data = data[0:lsize]
         return data,cksum
 
+    def _readv_coalesced(self, blockv):
+        # Reads the (device, offset, size) segments of blockv. Segments close
+        # to each other on the same disk are read as one, the gaps between
+        # them are read and thrown away. Returns one view per segment.
+        order = sorted(range(len(blockv)), key=lambda i: (blockv[i][0], blockv[i][1]))
+        merged = []
+        where = [None] * len(blockv)
+        for i in order:
+            dev, offset, size = blockv[i]
+            if merged:
+                m = merged[-1]
+                end = max(m[2], offset + size)
+                if m[0] == dev and offset <= m[2] + COALESCE_GAP and end - m[1] <= COALESCE_MAX:
+                    m[2] = end
+                    where[i] = (len(merged) - 1, offset - m[1])
+                    continue
+            merged.append([dev, offset, offset + size])
+            where[i] = (len(merged) - 1, 0)
+        if self._verbose >= LOG_NOISY:
+            print("[+]  {} segments in {} reads".format(len(blockv), len(merged)))
+        bufs = self._bp.readv_segments([(m[0], m[1], m[2] - m[1]) for m in merged])
+        pieces = []
+        for i, (m, off) in enumerate(where):
+            pieces.append(memoryview(bufs[m])[off:off+blockv[i][2]])
+        return pieces
+
     def _read_physical(self, offset, psize, debug_dump, debug_prefix):
+        plan = self._map_physical(offset, psize)
+        if plan is None:
+            return None
+        col_data = self._bp.readv_segments(plan[0])
+        return self._assemble_physical(plan, col_data, debug_dump, debug_prefix)
+
+    def _map_physical(self, offset, psize):
+        # Returns the segments of the children to read, followed by whatever
+        # _assemble_physical() needs, or None if the block cannot be read
+        raise RuntimeError("Attempted read from generic device!")
+
+    def _assemble_physical(self, plan, col_data, debug_dump, debug_prefix):
         raise RuntimeError("Attempted read from generic device!")
 
 
 class MirrorDevice(GenericDevice):
 
-    def __init__(self, child_vdevs, proxy_addr, ashift=9, bad=None, dump_dir="/tmp"):
-        super().__init__(child_vdevs, proxy_addr, dump_dir=dump_dir)
+    def __init__(self, child_vdevs, proxy_addr, ashift=9, bad=None, dump_dir="/tmp", compression=None):
+        super().__init__(child_vdevs, proxy_addr, dump_dir=dump_dir, compression=compression)
         self._ashift = ashift
-        self._bad = bad
-        if self._bad and len(self._bad) > len(self._devs):
+        self._bad = bad if bad is not None else []
+        if len(self._bad) > len(self._devs):
             print("[-] Mirror created with more bad disks than copies!")
-
-    def _read_physical(self, offset, psize, debug_dump, debug_prefix):
+        self._healthy = [i for i in range(len(self._devs)) if i not in self._bad]
+        if not self._healthy:
+            self._healthy = list(range(len(self._devs)))
+
+    def _choose_side(self, offset):
+        # Like the kernel, spread reads by region: neighbouring blocks come
+        # from the same disk and can be merged, large files are read from
+        # all healthy disks
+        return self._healthy[(offset >> MIRROR_SHIFT) % len(self._healthy)]
+
+    def _map_physical(self, offset, psize, side=None):
+        if side is None:
+            side = self._choose_side(offset)
         if self._verbose >= LOG_NOISY:
-            print("[+]  Reading from {}:{}:{}".format(self._devs[0], offset, psize))
-        data = self._bp.read(self._devs[0], offset + 0x400000, psize)
+            print("[+]  Reading from {}:{}:{}".format(self._devs[side], offset, psize))
+        return ([(self._devs[side], offset + 0x400000, psize)], offset, side)
+
+    def _assemble_physical(self, plan, col_data, debug_dump, debug_prefix):
+        data = col_data[0]
         if debug_dump:
-            f = open(path.join(self._dump_dir, "{}-{}:{}.raw".format(debug_prefix, 0, offset)), "wb")
+            f = open(path.join(self._dump_dir, "{}-{}:{}.raw".format(debug_prefix, plan[2], plan[1])), "wb")
             f.write(data)
             f.close()
         return data
 
+    def _recover_physical(self, offset, rsize, verify):
+        # Try the other sides, the healthy ones first
+        first = self._choose_side(offset)
+        sides = [i for i in self._healthy if i != first] + [i for i in self._bad if i != first]
+        for side in sides:
+            plan = self._map_physical(offset, rsize, side=side)
+            data = self._assemble_physical(plan, self._bp.readv_segments(plan[0]), False, None)
+            if verify(data):
+                print("[+]  Block at {} read from {}".format(hex(offset)[2:], self._devs[side]))
+                return data
+        return None
+
 
 class RaidzDevice(GenericDevice):
 
-    def __init__(self, child_vdevs, nparity, proxy_addr, ashift=9, bad=None, repair=False, dump_dir="/tmp"):
-        super().__init__(child_vdevs, proxy_addr, dump_dir=dump_dir)
+    def __init__(self, child_vdevs, nparity, proxy_addr, ashift=9, bad=None, repair=False, dump_dir="/tmp",
+                 optimistic=True, compression=None):
+        super().__init__(child_vdevs, proxy_addr, dump_dir=dump_dir, compression=compression)
         self._ashift = ashift
         self._nparity = nparity
-        self._bad = bad
+        self._bad = bad if bad is not None else []
         self._repair = repair
-        if self._nparity != 1:
-            print("[-] Raidz with parity != 1 is not supported!")
+        # Read the data columns only and go for the parity after a
+        # checksum failure
+        self._optimistic = optimistic
+        self._map_cache = {}
+        if not 1 <= self._nparity <= 3:
+            print("[-] Raidz with parity {} is not supported!".format(self._nparity))
         if self._bad and len(self._bad) > self._nparity:
             print("[-] Raidz created with more bad disks than parity allows!")
 
-    def _read_physical(self, offset, psize, debug_dump, debug_prefix):
+    def _map_physical(self, offset, psize, full=False):
         if offset > 8*1024*1024*1024*1024: # 3tb, unrealistic
             print ("[-] offset limit reached %d" %(offset))
             return None
-        (cols, firstdatacol, skipstart) = self._map_alloc(offset, psize, self._ashift)
-        col_data = []
-        blockv = []
-        for c in range(len(cols)):
-            col = cols[c]
-            devidx = col["rc_devidx"]
-            offset = col["rc_offset"]
-            size = col["rc_size"]
-            if debug_dump:
+        (cols, firstdatacol, skipstart) = self._map_shape(offset, psize, self._ashift)
+        # Parity is only needed up front to repair known bad disks
+        first = 0
+        if self._optimistic and not full and not (self._repair and self._bad):
+            first = firstdatacol
+        row = (((offset >> self._ashift) // len(self._devs)) << self._ashift) + 0x400000
+        devs = self._devs
+        blockv = [(devs[devidx], row + coff, size) for (devidx, coff, size) in cols[first:]]
+        if self._verbose >= LOG_NOISY:
+            for c, (devidx, coff, size) in enumerate(cols[first:], first):
                 p = "" if c >= firstdatacol else " (parity)"
                 bad = " BAD" if devidx in self._bad else ""
-                if self._verbose >= LOG_NOISY:
-                    print("[+]  Reading from {} at {}:{}{}{}".format(self._devs[devidx], offset, size, p, bad))
-            blockv.append((self._devs[devidx], offset + 0x400000, size))
-        data = self._bp.readv(blockv)
-        ptr = 0
-        for c in range(len(cols)):
-            col = cols[c]
-            size = col["rc_size"]
-            piece = data[ptr:ptr+size]
-            col_data.append(piece)
-            ptr += size
-            if debug_dump:
-                devidx = col["rc_devidx"]
-                offset = col["rc_offset"]
+                print("[+]  Reading from {} at {}:{}{}{}".format(devs[devidx], row + coff - 0x400000, size, p, bad))
+        return (blockv, cols, firstdatacol, first)
+
+    def _assemble_physical(self, plan, col_data, debug_dump, debug_prefix):
+        # Columns are slices of the proxy buffers, no copies are made here
+        (blockv, cols, firstdatacol, first) = plan
+        col_data = list(col_data)
+        if debug_dump:
+            for c in range(len(blockv)):
+                devidx = cols[first + c][0]
+                offset = blockv[c][1] - 0x400000
                 f = open(path.join(self._dump_dir, "{}-{}.{}:{}.raw".format(debug_prefix, c, devidx, offset)), "wb")
-                f.write(piece)
+                f.write(col_data[c])
                 f.close()
-        if self._repair and len(self._bad) > 0:
-            # Only support a single bad drive
-            devs = [c["rc_devidx"] for c in cols]
-            # Drop parity if stored on the bad disk
-            if self._bad[0] in devs[1:]:
-                parity = col_data[0]
-                bad = devs.index(self._bad[0])
-                bad_size = cols[bad]["rc_size"]
+        if first == 0 and self._repair and self._bad:
+            missing = [c for c in range(len(cols)) if cols[c][0] in self._bad]
+            # Nothing to do if only parity is stored on the bad disks
+            if any(c >= firstdatacol for c in missing):
                 if self._verbose >= LOG_NOISY:
-                    print("[+]  Repairing {} bad bytes".format(bad_size))
-                for b in range(1, len(col_data)):
-                    if b != bad:
-                        self._xor(parity, col_data[b])
-                col_data[bad] = parity[:bad_size]
-        data = bytearray()
-        for c in col_data[firstdatacol:]:
-            data += c
-        return data
+                    print("[+]  Repairing {} bad columns".format(len(missing)))
+                rebuilt = raidz.reconstruct(col_data, self._nparity, missing)
+                if rebuilt is None:
+                    print("[-]  Too many bad columns to reconstruct the block")
+                else:
+                    col_data = rebuilt
+        return self._join_data(col_data[firstdatacol - first:])
 
     @staticmethod
-    def _xor(p, d):
-        for i in range(len(d)):
-            p[i] ^= d[i]
+    def _join_data(data_cols):
+        if len(data_cols) == 1:
+            return data_cols[0]
+        return bytearray().join(data_cols)
+
+    def _recover_physical(self, offset, rsize, verify):
+        # Combinatorial reconstruction: read all columns and rebuild the
+        # data with every combination of up to nparity columns assumed bad
+        # until the checksum matches
+        plan = self._map_physical(offset, rsize, full=True)
+        if plan is None:
+            return None
+        (blockv, cols, firstdatacol, first) = plan
+        col_data = list(self._bp.readv_segments(blockv))
+        ncols = len(cols)
+        for k in range(self._nparity + 1):
+            for suspects in itertools.combinations(range(ncols), k):
+                if k > 0 and suspects[-1] < firstdatacol:
+                    # Only parity columns, the data is what was tried before
+                    continue
+                rebuilt = raidz.reconstruct(col_data, self._nparity, list(suspects))
+                if rebuilt is None:
+                    continue
+                data = self._join_data(rebuilt[firstdatacol:])
+                if not verify(data):
+                    continue
+                if self._verbose >= LOG_VERBOSE or suspects:
+                    bad = ", ".join(self._devs[cols[c][0]] for c in suspects)
+                    print("[+]  Block at {} rebuilt from parity, bad data on {}".format(
+                        hex(offset)[2:], bad if bad else "none"))
+                return data
+        return None
 
     def _map_alloc(self, io_offset, io_size, unit_shift):
+        """
+        Returns the columns of a block as (devidx, offset, size) tuples, the
+        first data column and the skip start.
+        """
+        row = ((io_offset >> unit_shift) // len(self._devs)) << unit_shift
+        (cols, firstdatacol, skipstart) = self._map_shape(io_offset, io_size, unit_shift)
+        return tuple((devidx, row + coff, size) for (devidx, coff, size) in cols), firstdatacol, skipstart
+
+    def _map_shape(self, io_offset, io_size, unit_shift):
+        # The layout only depends on the first column of the block, its size
+        # and the raidz1 parity swap, so it is computed once per shape with
+        # offsets relative to the block's row on the children
+        key = ((io_offset >> unit_shift) % len(self._devs), io_size >> unit_shift, unit_shift,
+               self._nparity == 1 and (io_offset & (1 << 20)) != 0)
+        shape = self._map_cache.get(key)
+        if shape is None:
+            if len(self._map_cache) >= MAP_CACHE_SIZE:
+                self._map_cache.clear()
+            shape = self._map_cache[key] = self._compute_shape(*key)
+        return shape
+
+    def _compute_shape(self, f, s, unit_shift, swap):
         dcols = len(self._devs)
-        # The starting RAIDZ (parent) vdev sector of the block.
-        b = io_offset >> unit_shift
-        # The zio's size in units of the vdev's minimum sector size.
-        s = io_size >> unit_shift
-        # The first column for this stripe.
-        f = b % dcols
-        # The starting byte offset on each child vdev.
-        o = (b // dcols) << unit_shift
 
         # "Quotient": The number of data sectors for this stripe on all but
         # the "big column" child vdevs that also contain "remainder" data.
@@ -261,10 +693,6 @@ class RaidzDevice(GenericDevice):
         # The number of "big columns" - those which contain remainder data.
         bc = (r + self._nparity) if r else 0
 
-        # The total number of data and parity sectors associated with
-        # this I/O.
-        tot = s + self._nparity * (q + (1 if r else 0))
-
         # acols: The columns that will be accessed.
         # scols: The columns that will be accessed or skipped.
         if q == 0:
@@ -279,33 +707,166 @@ class RaidzDevice(GenericDevice):
         rm_firstdatacol = self._nparity
         rm_cols = []
 
-        for c in range(scols):
+        for c in range(min(scols, acols)):
             col = f + c
-            coff = o
+            coff = 0
             if col >= dcols:
                 col -= dcols
                 coff += (1 << unit_shift)
-            rm_col = {"rc_devidx": col, "rc_offset": coff}
-            if c >= acols:
-                rm_col["rc_size"] = 0
-            elif c < bc:
-                rm_col["rc_size"] = (q + 1) << unit_shift
+            if c < bc:
+                size = (q + 1) << unit_shift
             else:
-                rm_col["rc_size"] = q << unit_shift
-            if rm_col["rc_size"] > 0:
-                rm_cols.append(rm_col)
-
-        if (rm_firstdatacol == 1) and (io_offset & (1 << 20)):
-            devidx = rm_cols[0]["rc_devidx"]
-            o = rm_cols[0]["rc_offset"]
-            rm_cols[0]["rc_devidx"] = rm_cols[1]["rc_devidx"]
-            rm_cols[0]["rc_offset"] = rm_cols[1]["rc_offset"]
-            rm_cols[1]["rc_devidx"] = devidx
-            rm_cols[1]["rc_offset"] = o
+                size = q << unit_shift
+            if size > 0:
+                rm_cols.append((col, coff, size))
+
+        if swap:
+            (dev0, off0, size0), (dev1, off1, size1) = rm_cols[0], rm_cols[1]
+            rm_cols[0] = (dev1, off1, size0)
+            rm_cols[1] = (dev0, off0, size1)
             if rm_skipstart == 0:
                 rm_skipstart = 1
 
-        return rm_cols, rm_firstdatacol, rm_skipstart
+        return tuple(rm_cols), rm_firstdatacol, rm_skipstart
+
+class PoolDevice(GenericDevice):
+    """
+    A pool striped over several top-level vdevs. Routes every DVA to the
+    device of its vdev.
+    """
+
+    def __init__(self, vdevs, proxy_addr, dump_dir="/tmp", compression=None):
+        super().__init__([], proxy_addr, dump_dir=dump_dir, compression=compression)
+        # Top-level vdev id -> device
+        self._vdevs = dict(vdevs)
+        for vdev in self._vdevs.values():
+            vdev._root = self
+        self._ashift = min(v._ashift for v in self._vdevs.values())
+        self._io = ThreadPoolExecutor(max_workers=max(len(self._vdevs), 1))
+
+    def set_verbosity_level(self, level):
+        super().set_verbosity_level(level)
+        for vdev in self._vdevs.values():
+            vdev.set_verbosity_level(level)
+
+    def set_cache(self, cache):
+        super().set_cache(cache)
+        for vdev in self._vdevs.values():
+            vdev.set_cache(cache)
+
+    def set_store(self, store):
+        super().set_store(store)
+        for vdev in self._vdevs.values():
+            vdev.set_store(store)
+
+    def _route(self, bptr, dva):
+        if bptr.empty or bptr._embeded:
+            # No DVA, any device can handle these
+            return next(iter(self._vdevs.values()))
+        vdev = self._vdevs.get(bptr.get_dva(dva)._vdev)
+        if vdev is None:
+            print("[-] Block on unknown vdev {}".format(bptr.get_dva(dva)._vdev))
+        return vdev
+
+    def read_block(self, bptr, dva=0, debug_dump=False, debug_prefix="block"):
+        vdev = self._route(bptr, dva)
+        if vdev is None:
+            return None,False
+        return vdev.read_block(bptr, dva, debug_dump, debug_prefix)
+
+    def _read_physical_batch(self, bptrs, dva):
+        # Split the batch per vdev and read from all vdevs at the same time.
+        # Gang members are read afterwards by read_physical_blocks(), from
+        # this thread, so that the vdev threads never wait for each other.
+        results = [(None, (None, False))] * len(bptrs)
+        groups = {}
+        for i, bptr in enumerate(bptrs):
+            vdev = self._route(bptr, dva) if bptr is not None else None
+            if vdev is not None:
+                groups.setdefault(id(vdev), (vdev, []))[1].append(i)
+        if len(groups) == 1:
+            jobs = [(vdev, idx, None) for vdev, idx in groups.values()]
+        else:
+            jobs = [(vdev, idx, self._io.submit(vdev._read_physical_batch, [bptrs[i] for i in idx], dva))
+                    for vdev, idx in groups.values()]
+        for vdev, idx, future in jobs:
+            if future is None:
+                group = vdev._read_physical_batch([bptrs[i] for i in idx], dva)
+            else:
+                group = future.result()
+            for i, result in zip(idx, group):
+                results[i] = result
+        return results
+
+    def recover_block(self, bptr, dva=0):
+        vdev = self._route(bptr, dva)
+        if vdev is None:
+            return None
+        return vdev.recover_block(bptr, dva)
+
+    def _read_gang_header(self, bptr, dva, raw):
+        return self._route(bptr, dva)._read_gang_header(bptr, dva, raw)
+
+
+def vdev_from_config(tree, proxy_addr, bad=None, repair=False, dump_dir="/tmp", compression=None):
+    """
+    Creates the device of a top-level vdev from its vdev_tree nvlist, as
+    found in the label of any of its disks.
+    """
+    vtype = tree.get('type', 'disk')
+    ashift = tree.get('ashift', 9)
+    if vtype == 'raidz':
+        disks, bad = _child_disks(tree, bad)
+        return RaidzDevice(disks, tree.get('nparity', 1), proxy_addr, ashift=ashift, bad=bad,
+                           repair=repair, dump_dir=dump_dir, compression=compression)
+    if vtype == 'mirror':
+        disks, bad = _child_disks(tree, bad)
+        return MirrorDevice(disks, proxy_addr, ashift=ashift, bad=bad, dump_dir=dump_dir,
+                            compression=compression)
+    if 'children' in tree:
+        # A disk being replaced or spared reads like a mirror of its old
+        # and new disks, with the old one tried first
+        leaves = _leaf_disks(tree)
+        bad = [i for i, (disk, healthy) in enumerate(leaves) if i > 0 or not healthy]
+        return MirrorDevice([disk for disk, healthy in leaves], proxy_addr, ashift=ashift, bad=bad,
+                            dump_dir=dump_dir, compression=compression)
+    # A single disk reads like a mirror with one side
+    return MirrorDevice([tree['path']], proxy_addr, ashift=ashift, dump_dir=dump_dir,
+                        compression=compression)
+
+
+def _leaf_disks(tree):
+    # Returns (path, healthy) for every disk below tree, in label order
+    if 'children' not in tree:
+        path = tree.get('path')
+        if path is None:
+            # Missing disk, reads of it fail and come back as zeros
+            return [("missing-{}".format(tree.get('guid', 0)), False)]
+        return [(path, not any(tree.get(flag) for flag in UNHEALTHY_FLAGS))]
+    return [leaf for child in tree['children'] for leaf in _leaf_disks(child)]
+
+def _child_disks(tree, bad=None):
+    """
+    Returns the disk to read every child of a raidz or mirror vdev tree from,
+    and bad extended by the children that may not hold good data. Replacing
+    and spare children are read from their original disk while it is
+    healthy, otherwise from the first healthy disk that replaced it, which
+    may have been resilvered only in part.
+    """
+    disks = []
+    bad = list(bad) if bad is not None else []
+    for i, child in enumerate(tree['children']):
+        leaves = _leaf_disks(child)
+        disk, healthy = next((leaf for leaf in leaves if leaf[1]), leaves[0])
+        if len(leaves) > 1:
+            print("[+] Child {} ({}) of vdev {} is read from {}".format(
+                i, child.get('type'), tree.get('id', 0), disk))
+        if (not healthy or disk != leaves[0][0]) and i not in bad:
+            print("[-] Disk {} of vdev {} may hold bad data".format(disk, tree.get('id', 0)))
+            bad.append(i)
+        disks.append(disk)
+    return disks, bad
+
 
 def dumppacket(data):
     l = roundup(len(data),32)//32
@@ -34,7 +34,9 @@ from zfs.label import Label
 from zfs.zap import zap_factory
 from zfs.dataset import Dataset
 from zfs.objectset import ObjectSet
-from zfs.zio import RaidzDevice             # or MirrorDevice
+from zfs.zio import PoolDevice, vdev_from_config
+from zfs.pipeline import BlockPipeline
+from zfs.cache import BlockCache, BlockStore, CACHE_SIZE
 from zfs.blocktree import BlockTree
 from zfs.col import color
 
@@ -47,9 +49,18 @@ parser = argparse.ArgumentParser(description='zfs_rescue')
 parser.add_argument('--verbose', '-v', dest='verbose', action='count', default=0)
 parser.add_argument('--files', '-f', dest='files', type=str, default=None,
                     help='Read blocks from files, specify disks.tab location')
-parser.add_argument('--label', '-l', dest='label', type=str, default='/dev/dsk/c3t0d0s7',
-                    help='Device where to read the initial label from')
+parser.add_argument('--label', '-l', dest='label', type=str, action='append', default=None,
+                    help='Device where to read the initial label from, repeat with a disk '
+                         'of every other top-level vdev of striped pools')
 parser.add_argument('--child', '-C', dest='child', action='count', default=0, help='Archive first child dataset')
+parser.add_argument('--workers', '-w', dest='workers', type=int, default=0,
+                    help='Decode file blocks in this many processes while reading ahead')
+parser.add_argument('--compress', '-z', dest='compress', choices=['zlib', 'lz4'], default=None,
+                    help='Ask the block server to compress the transfers')
+parser.add_argument('--cache-size', '-m', dest='cache_size', type=int, default=CACHE_SIZE >> 20,
+                    help='Memory in MiB for caching decoded blocks')
+parser.add_argument('--cache', '-c', dest='cache', type=str, default=None,
+                    help='Keep metadata blocks in this file and reuse them in later runs')
 args = parser.parse_args()
 
 if args.verbose > 0:
@@ -58,7 +69,10 @@ if args.verbose > 0:
 BLK_PROXY_ADDR = ("localhost", 24892)       # network block server
 if not args.files is None:
     BLK_PROXY_ADDR = ("files:", args.files)  # local device nodes
-BLK_INITIAL_DISK = args.label      # device to read the label from
+if args.label is None:
+    args.label = ['/dev/dsk/c3t0d0s7']
+BLK_INITIAL_DISK = args.label[0]   # device to read the label from
+BAD_DISKS = [3]                    # bad disks of the initial disk's vdev
 
 TXG = -1                                    # select specific transaction or -1 for the active one
 
@@ -70,105 +84,137 @@ DS_OBJECTS_SKIP = []                        # objects to skip
 DS_SKIP_TRAVERSE = []                       # datasets to skip while exporting file lists
 FAST_ANALYSIS = True
 
-print("[+] zfs_rescue v0.3183")
-
-lnum = 0
-print("[+] Reading label {} on disk {}".format(lnum, BLK_INITIAL_DISK))
-bp = BlockProxy(BLK_PROXY_ADDR)
-id_l = Label(bp, BLK_INITIAL_DISK)
-id_l.read(0)
-id_l.debug()
-all_disks = id_l.get_vdev_disks()
-
-pool_dev = RaidzDevice(all_disks, 1, BLK_PROXY_ADDR, bad=[3], ashift=id_l._ashift, repair=True, dump_dir=OUTPUT_DIR)
-# pool_dev = MirrorDevice(all_disks, BLK_PROXY_ADDR, dump_dir=OUTPUT_DIR)
-
-print("[+] Loading uberblocks from child vdevs")
-uberblocks = {}
-for disk in all_disks:
-    bp = BlockProxy(BLK_PROXY_ADDR)
-    l0 = Label(bp, disk)
-    l0.read(0)
-    l1 = Label(bp, disk)
-    l1.read(1)
-    ub = l0.find_active_ub()
-    ub_found = " (active UB txg {})".format(ub.txg) if ub is not None else ""
-    print("[+]  Disk {}: L0 txg {}{}, L1 txg {}".format(disk, l0.get_txg(), ub_found, l1.get_txg()))
-    uberblocks[disk] = ub
-
-# print("\n[+] Active uberblocks:")
-# for disk in uberblocks.keys():
-#     print(disk)
-#     uberblocks[disk].debug()
-
-ub = id_l.find_ub_txg(TXG)
-if ub:
-    root_blkptr = ub.rootbp
-    print("[+] Selected uberblock with txg", TXG)
-else:
-    root_blkptr = uberblocks[BLK_INITIAL_DISK].rootbp
-    print("[+] Selected active uberblock from initial disk")
-
-print("[+] Reading MOS: {}".format(root_blkptr))
-
-datasets = {}
-
-# Try all copies of the MOS
-for dva in range(3):
-    mos = ObjectSet(pool_dev, root_blkptr, dvas=(dva,))
-    for n in range(len(mos)):
-        d = mos[n]
-        # print("[+]  dnode[{:>3}]={}".format(n, d))
-        if d and d.type == 16:
-            datasets[n] = d
-
-print("[+] add one level of child datasets")
-try:
-    rds_z = mos[1]
-    rds_zap = zap_factory(pool_dev, rds_z)
-    rds_id = rds_zap['root_dataset']
-    rdir = mos[rds_id]
-    cdzap_id = rdir.bonus.dd_child_dir_zapobj
-    cdzap_z = mos[cdzap_id]
-    cdzap_zap = zap_factory(pool_dev, cdzap_z)
-    for k,v in cdzap_zap._entries.items():
-        if not k[0:1] == '$': 
-            child = mos[v]
-            cds = child.bonus.dd_head_dataset_obj
-            print("[+] child %s with dataset %d" %(k,cds))
-            # mos[cds] points to a 'zap' with "bonus  DSL dataset"
-            datasets[cds] = mos[cds]
-            if args.child:
-                DS_TO_ARCHIVE.append(cds);
-except:
-    pass
-    
-print("[+] {} datasets found".format(len(datasets)))
-
-for dsid in datasets:
-    print("[+] Dataset "+color.GREEN+("%d" %(dsid))+color.END)
-    ds_dnode = datasets[dsid]
-    print("[+]  dnode {}".format(ds_dnode))
-    ds_creation_time = datetime.datetime.fromtimestamp(ds_dnode.bonus.ds_creation_time).strftime('%Y-%m-%d %H:%M:%S')
-    print("[+]  creation timestamp {}".format(ds_creation_time))
-    print("[+]  creation txg {}".format(ds_dnode.bonus.ds_creation_txg))
-    print("[+]  {} uncompressed bytes".format(ds_dnode.bonus.ds_uncompressed_bytes))
-    if FAST_ANALYSIS:
-        continue
-    ddss = Dataset(pool_dev, ds_dnode)
-    ddss.analyse()
-    if dsid not in DS_SKIP_TRAVERSE:
-        ddss.export_file_list(path.join(OUTPUT_DIR, "ds_{}_filelist.csv".format(dsid)))
-
-for dsid in DS_TO_ARCHIVE:
-    ddss = Dataset(pool_dev, datasets[dsid], dvas=(0,1))
-    ddss.analyse()
-    # ddss.prefetch_object_set()
-    if not path.exists(OUTPUT_DIR):
-        makedirs(OUTPUT_DIR)
-    if len(DS_OBJECTS) > 0:
-        for dnid, objname in DS_OBJECTS:
-            ddss.archive(path.join(OUTPUT_DIR, "ds_{}_{}.tar".format(dsid, objname)),
-                         dir_node_id=dnid, skip_objs=DS_OBJECTS_SKIP, temp_dir=TEMP_DIR)
+
+def main():
+    print("[+] zfs_rescue v0.3183")
+
+    lnum = 0
+    print("[+] Reading label {} on disk {}".format(lnum, BLK_INITIAL_DISK))
+    bp = BlockProxy(BLK_PROXY_ADDR, compression=args.compress)
+    id_l = Label(bp, BLK_INITIAL_DISK)
+    id_l.read(0)
+    id_l.debug()
+    all_disks = id_l.get_vdev_disks()
+
+    # One device per top-level vdev, built from the vdev tree in its labels
+    vdevs = {}
+    tree = id_l.get_vdev_tree()
+    vdevs[tree.get('id', 0)] = vdev_from_config(tree, BLK_PROXY_ADDR, bad=BAD_DISKS, repair=True, dump_dir=OUTPUT_DIR,
+                                                compression=args.compress)
+    for disk in args.label[1:]:
+        l = Label(bp, disk)
+        l.read(0)
+        tree = l.get_vdev_tree()
+        print("[+] Top-level vdev {} ({}) from disk {}".format(tree.get('id', 0), tree.get('type'), disk))
+        vdevs[tree.get('id', 0)] = vdev_from_config(tree, BLK_PROXY_ADDR, dump_dir=OUTPUT_DIR, compression=args.compress)
+        all_disks += [d for d in l.get_vdev_disks() if d not in all_disks]
+
+    pool_dev = PoolDevice(vdevs, BLK_PROXY_ADDR, dump_dir=OUTPUT_DIR, compression=args.compress)
+    block_cache = BlockCache(args.cache_size << 20)
+    pool_dev.set_cache(block_cache)
+    block_store = None
+    if args.cache is not None:
+        block_store = BlockStore(args.cache)
+        pool_dev.set_store(block_store)
+    if args.workers > 0:
+        pool_dev.set_pipeline(BlockPipeline(pool_dev, workers=args.workers))
+
+    print("[+] Loading uberblocks from child vdevs")
+    uberblocks = {}
+    for disk in all_disks:
+        l0 = Label(bp, disk)
+        l0.read(0)
+        l1 = Label(bp, disk)
+        l1.read(1)
+        ub = l0.find_active_ub()
+        ub_found = " (active UB txg {})".format(ub.txg) if ub is not None else ""
+        print("[+]  Disk {}: L0 txg {}{}, L1 txg {}".format(disk, l0.get_txg(), ub_found, l1.get_txg()))
+        uberblocks[disk] = ub
+    # The labels are read, the devices have connections of their own
+    bp.close()
+
+    # print("\n[+] Active uberblocks:")
+    # for disk in uberblocks.keys():
+    #     print(disk)
+    #     uberblocks[disk].debug()
+
+    ub = id_l.find_ub_txg(TXG)
+    if ub:
+        root_blkptr = ub.rootbp
+        print("[+] Selected uberblock with txg", TXG)
     else:
-        ddss.archive(path.join(OUTPUT_DIR, "ds_{}.tar".format(dsid)), skip_objs=DS_OBJECTS_SKIP, temp_dir=TEMP_DIR)
+        root_blkptr = uberblocks[BLK_INITIAL_DISK].rootbp
+        print("[+] Selected active uberblock from initial disk")
+
+    print("[+] Reading MOS: {}".format(root_blkptr))
+
+    datasets = {}
+
+    # Try all copies of the MOS
+    for dva in range(3):
+        mos = ObjectSet(pool_dev, root_blkptr, dvas=(dva,))
+        for n in range(len(mos)):
+            d = mos[n]
+            # print("[+]  dnode[{:>3}]={}".format(n, d))
+            if d and d.type == 16:
+                datasets[n] = d
+
+    print("[+] add one level of child datasets")
+    try:
+        rds_z = mos[1]
+        rds_zap = zap_factory(pool_dev, rds_z)
+        rds_id = rds_zap['root_dataset']
+        rdir = mos[rds_id]
+        cdzap_id = rdir.bonus.dd_child_dir_zapobj
+        cdzap_z = mos[cdzap_id]
+        cdzap_zap = zap_factory(pool_dev, cdzap_z)
+        for k,v in cdzap_zap._entries.items():
+            if not k[0:1] == '$': 
+                child = mos[v]
+                cds = child.bonus.dd_head_dataset_obj
+                print("[+] child %s with dataset %d" %(k,cds))
+                # mos[cds] points to a 'zap' with "bonus  DSL dataset"
+                datasets[cds] = mos[cds]
+                if args.child:
+                    DS_TO_ARCHIVE.append(cds);
+    except:
+        pass
+
+    print("[+] {} datasets found".format(len(datasets)))
+
+    for dsid in datasets:
+        print("[+] Dataset "+color.GREEN+("%d" %(dsid))+color.END)
+        ds_dnode = datasets[dsid]
+        print("[+]  dnode {}".format(ds_dnode))
+        ds_creation_time = datetime.datetime.fromtimestamp(ds_dnode.bonus.ds_creation_time).strftime('%Y-%m-%d %H:%M:%S')
+        print("[+]  creation timestamp {}".format(ds_creation_time))
+        print("[+]  creation txg {}".format(ds_dnode.bonus.ds_creation_txg))
+        print("[+]  {} uncompressed bytes".format(ds_dnode.bonus.ds_uncompressed_bytes))
+        if FAST_ANALYSIS:
+            continue
+        ddss = Dataset(pool_dev, ds_dnode)
+        ddss.analyse()
+        if dsid not in DS_SKIP_TRAVERSE:
+            ddss.export_file_list(path.join(OUTPUT_DIR, "ds_{}_filelist.csv".format(dsid)))
+
+    for dsid in DS_TO_ARCHIVE:
+        ddss = Dataset(pool_dev, datasets[dsid], dvas=(0,1))
+        ddss.analyse()
+        # ddss.prefetch_object_set()
+        if not path.exists(OUTPUT_DIR):
+            makedirs(OUTPUT_DIR)
+        if len(DS_OBJECTS) > 0:
+            for dnid, objname in DS_OBJECTS:
+                ddss.archive(path.join(OUTPUT_DIR, "ds_{}_{}.tar".format(dsid, objname)),
+                             dir_node_id=dnid, skip_objs=DS_OBJECTS_SKIP, temp_dir=TEMP_DIR)
+        else:
+            ddss.archive(path.join(OUTPUT_DIR, "ds_{}.tar".format(dsid)), skip_objs=DS_OBJECTS_SKIP, temp_dir=TEMP_DIR)
+
+    block_cache.print_stats()
+    if block_store is not None:
+        block_store.print_stats()
+        block_store.close()
+
+
+if __name__ == "__main__":
+    main()